@@ -0,0 +1,362 @@
+#!/usr/bin/env python3
+"""
+Benchmarks for the cloak_manager vault hot paths.
+
+Every run works in a throwaway HOME (so ~/.safekey is fresh) with a fake USB
+mount holding a .safekey_token. Each scenario phase (assign, reveal, hide, ...)
+runs in its own child process so its peak RSS is measured on its own.
+
+  python bench_cloak.py                      # all scenarios, scale 1
+  python bench_cloak.py --scale 0.1 --out before.json
+  python bench_cloak.py --compare before.json after.json
+  python bench_cloak.py --startup            # only CLI cold start / UI first paint
+"""
+
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import platform
+import resource
+import tempfile
+import subprocess
+import contextlib
+from pathlib import Path
+
+PASSWORD = "bench-password"
+MB = 1024 * 1024
+
+# scenario -> list of (file count, file size) at scale 1
+SCENARIOS = {
+    "small": [(5000, 4 * 1024)],
+    "huge": [(2, 256 * MB)],
+    "mixed": [(1500, 2 * 1024), (400, 64 * 1024), (90, 1 * MB), (10, 16 * MB)],
+}
+PHASES = ["assign", "reveal", "hide", "reveal", "hide_modified"]
+
+# lightweight CLI commands whose cold start (fresh interpreter, in-process mode)
+# should stay within STARTUP_BUDGET_MS on top of a bare `python -c pass`
+STARTUP_COMMANDS = {"usage": [], "unknown": ["bogus"], "listdrives": ["listdrives"]}
+STARTUP_BUDGET_MS = 100
+
+def percentiles(samples):
+    s = sorted(samples)
+    pick = lambda q: s[min(len(s) - 1, int(q * len(s)))]
+    return {"p50_ms": pick(0.50) * 1000, "p95_ms": pick(0.95) * 1000,
+            "p99_ms": pick(0.99) * 1000, "max_ms": s[-1] * 1000, "n": len(s)}
+
+def peak_rss_mb():
+    # VmHWM honours reset_peak_rss(); ru_maxrss never goes down
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports KiB, macOS bytes
+    return rss / (MB if sys.platform == "darwin" else 1024)
+
+def reset_peak_rss() -> bool:
+    """Restart the peak-RSS high-water mark at the current RSS (Linux only)."""
+    try:
+        with open("/proc/self/clear_refs", "w") as f:
+            f.write("5")
+        return True
+    except OSError:
+        return False
+
+def timed(fn, repeat):
+    samples = []
+    for _ in range(repeat):
+        t = time.perf_counter()
+        fn()
+        samples.append(time.perf_counter() - t)
+    return samples
+
+# --- child side: runs with HOME pointed at the bench dir ---
+def _import_manager():
+    sys.path.insert(0, str(Path(__file__).resolve().parent))
+    import cloak_manager
+    return cloak_manager
+
+def _write_tree(root: Path, spec, scale: float):
+    """Half the files are random bytes, half repetitive text (compressible)."""
+    n = 0
+    text = b"2024-01-01T00:00:00 INFO request handled in 12ms path=/api/items id=42\n"
+    for count, size in spec:
+        for i in range(max(1, int(count * scale))):
+            d = root / f"d{n // 500}"
+            d.mkdir(parents=True, exist_ok=True)
+            with open(d / f"f{n}", "wb") as f:
+                left = size
+                while left:
+                    step = min(left, 4 * MB)
+                    f.write(os.urandom(step) if n % 2 else (text * (step // len(text) + 1))[:step])
+                    left -= step
+            n += 1
+
+def _tree_stats(root: Path):
+    files = [Path(r) / f for r, _, fs in os.walk(root) for f in fs]
+    return len(files), sum(f.stat().st_size for f in files)
+
+def child_phase(phase: str, bench_dir: Path, scenario: str, scale: float) -> dict:
+    sk = _import_manager()
+    data = bench_dir / "data"
+    state = bench_dir / "state.json"
+    quiet = contextlib.redirect_stdout(open(os.devnull, "w"))
+    if phase == "setup":
+        mount = bench_dir / "usb"
+        mount.mkdir()
+        with quiet:
+            token = sk.provision(str(mount))
+        _write_tree(data, SCENARIOS[scenario], scale)
+        files, nbytes = _tree_stats(data)
+        state.write_text(json.dumps({"token": token, "files": files, "bytes": nbytes}))
+        return {"files": files, "bytes": nbytes}
+
+    st = json.loads(state.read_text())
+    token = st["token"]
+    key = sk._unlock(token, PASSWORD)  # KDF cost is measured separately in micro
+    # the unlock's Argon2id working set would otherwise pin the phase's peak RSS
+    rss_reset = reset_peak_rss()
+    rss_before = peak_rss_mb()
+    if phase == "hide_modified":
+        # bump mtimes so every revealed file fails its fingerprint and is re-sealed
+        for r, _, fs in os.walk(data):
+            for f in fs:
+                os.utime(Path(r) / f)
+    t = time.perf_counter()
+    with quiet:
+        if phase == "assign":
+            done, errors = sk.assign_files(token, key, sk.iter_files(data))
+            if errors:
+                raise RuntimeError(f"{len(errors)} assign errors, first: {errors[0]}")
+        elif phase == "reveal":
+            sk.reveal_for_token(token, PASSWORD)
+        elif phase in ("hide", "hide_modified"):
+            sk.hide_for_token(token, PASSWORD)
+    elapsed = time.perf_counter() - t
+    return {
+        "seconds": elapsed,
+        "files_per_s": st["files"] / elapsed,
+        "mb_per_s": st["bytes"] / MB / elapsed,
+        "peak_rss_mb": peak_rss_mb(),
+        "rss_at_start_mb": rss_before,
+        "peak_rss_excludes_unlock": rss_reset,
+    }
+
+def child_micro(bench_dir: Path, scale: float) -> dict:
+    sk = _import_manager()
+    out = {}
+    rep = lambda n: max(3, int(n * scale))
+    salt = os.urandom(16)
+    out["derive_key"] = percentiles(timed(lambda: sk.derive_key(PASSWORD, b"tok", salt), rep(5)))
+    key = sk.derive_key(PASSWORD, b"tok", salt)
+    for size in (4 * 1024, MB, 64 * MB):
+        data = os.urandom(size)
+        blob = sk.encrypt_blob(key, data)
+        n = rep(max(3, 256 * MB // size // 8))
+        enc = timed(lambda: sk.encrypt_blob(key, data), n)
+        dec = timed(lambda: sk.decrypt_blob(key, blob), n)
+        out[f"encrypt_blob_{size}"] = dict(percentiles(enc), mb_per_s=size * n / MB / sum(enc))
+        out[f"decrypt_blob_{size}"] = dict(percentiles(dec), mb_per_s=size * n / MB / sum(dec))
+
+    with contextlib.redirect_stdout(open(os.devnull, "w")):
+        token = sk.provision(str(bench_dir))
+    counter = iter(range(10 ** 9))
+    sealed = {"vault": "0" * 40, "fmt": sk.STREAM_FORMAT}
+    out["_save_vault_item"] = percentiles(timed(
+        lambda: sk._save_vault_item(token, f"/bench/{next(counter)}", sealed), rep(2000)))
+
+    victims = bench_dir / "victims"
+    victims.mkdir()
+    for size, n in ((4 * 1024, rep(1000)), (64 * MB, rep(2))):
+        paths = []
+        for i in range(n):
+            p = victims / f"{size}-{i}"
+            p.write_bytes(os.urandom(size))
+            paths.append(p)
+        it = iter(paths)
+        samples = timed(lambda: sk.secure_delete_file(next(it)), n)
+        out[f"secure_delete_file_{size}"] = dict(percentiles(samples), mb_per_s=size * n / MB / sum(samples))
+
+    out["list_all_usb_drives"] = percentiles(timed(sk.list_all_usb_drives, rep(50)))
+    out["peak_rss_mb"] = peak_rss_mb()
+    return out
+
+def child_ui_paint() -> dict:
+    """Build SafeKeyUI offscreen and report when its first paint event arrives."""
+    t0 = time.perf_counter()
+    sys.path.insert(0, str(Path(__file__).resolve().parent))
+    import cloak_ui
+    from PySide6.QtCore import QObject, QEvent, QTimer
+    t1 = time.perf_counter()
+    app = cloak_ui.QApplication([])
+    w = cloak_ui.SafeKeyUI()
+    t2 = time.perf_counter()
+    painted = {}
+
+    class FirstPaint(QObject):
+        def eventFilter(self, obj, event):
+            if event.type() == QEvent.Paint and not painted:
+                painted["t"] = time.perf_counter()
+                QTimer.singleShot(0, app.quit)
+            return False
+
+    w.installEventFilter(FirstPaint(w))
+    w.show()
+    app.exec()
+    return {"import_ms": (t1 - t0) * 1000, "init_ms": (t2 - t1) * 1000,
+            "paint_ms": (painted["t"] - t2) * 1000, "in_process_ms": (painted["t"] - t0) * 1000}
+
+# --- parent side ---
+def run_child(args, bench_dir: Path) -> dict:
+    env = dict(os.environ, HOME=str(bench_dir / "home"))
+    cmd = [sys.executable, __file__, "--child", *args, "--dir", str(bench_dir)]
+    res = subprocess.run(cmd, env=env, capture_output=True, text=True)
+    if res.returncode != 0:
+        raise RuntimeError(f"bench child {args} failed:\n{res.stderr}")
+    return json.loads(res.stdout.strip().splitlines()[-1])
+
+def run_all(scenarios, scale: float, workdir: str) -> dict:
+    results = {"micro": None, "scenarios": {}}
+    with tempfile.TemporaryDirectory(prefix="cloak-bench-", dir=workdir) as tmp:
+        tmp = Path(tmp)
+        bench_dir = tmp / "micro"
+        (bench_dir / "home").mkdir(parents=True)
+        print("micro benchmarks ...")
+        results["micro"] = run_child(["micro", "--scale", str(scale)], bench_dir)
+        for name in scenarios:
+            bench_dir = tmp / name
+            (bench_dir / "home").mkdir(parents=True)
+            print(f"scenario {name}: generating ...")
+            sc = {"tree": run_child(["setup", "--scenario", name, "--scale", str(scale)], bench_dir)}
+            for i, phase in enumerate(PHASES):
+                label = phase if phase not in sc else f"{phase}_{i}"
+                sc[label] = run_child([phase, "--scenario", name, "--scale", str(scale)], bench_dir)
+                print(f"  {label:14s} {sc[label]['seconds']:8.3f}s  {sc[label]['mb_per_s']:9.1f} MB/s"
+                      f"  {sc[label]['files_per_s']:9.0f} files/s  rss {sc[label]['peak_rss_mb']:.0f} MB")
+            results["scenarios"][name] = sc
+            shutil.rmtree(bench_dir, ignore_errors=True)
+    return results
+
+def run_startup(scale: float, workdir: str) -> dict:
+    """
+    Wall time of fresh interpreters: bare python, each STARTUP_COMMANDS entry run
+    as `python -m cloak_manager` (in-process, no daemon), and SafeKeyUI's first
+    paint (offscreen Qt) when PySide6 is installed.
+    """
+    here = Path(__file__).resolve().parent
+    repeat = max(5, int(20 * scale))
+    results = {}
+    with tempfile.TemporaryDirectory(prefix="cloak-bench-", dir=workdir) as tmp:
+        env = dict(os.environ, HOME=tmp, SAFEKEY_DAEMON="0", QT_QPA_PLATFORM="offscreen")
+
+        def wall(cmd):
+            subprocess.run(cmd, env=env, cwd=here, capture_output=True)  # warm the bytecode/page cache
+            samples = []
+            for _ in range(repeat):
+                t = time.perf_counter()
+                subprocess.run(cmd, env=env, cwd=here, capture_output=True)
+                samples.append(time.perf_counter() - t)
+            return percentiles(samples)
+
+        base = wall([sys.executable, "-c", "pass"])
+        results["python"] = base
+        print(f"startup python -c pass      {base['p50_ms']:7.1f} ms")
+        for name, args in STARTUP_COMMANDS.items():
+            res = wall([sys.executable, "-m", "cloak_manager", *args])
+            res["over_python_ms"] = res["p50_ms"] - base["p50_ms"]
+            res["within_budget"] = res["over_python_ms"] <= STARTUP_BUDGET_MS
+            results[name] = res
+            print(f"startup {name:20s} {res['p50_ms']:7.1f} ms  (+{res['over_python_ms']:.1f} ms over python,"
+                  f" budget {STARTUP_BUDGET_MS} ms: {'ok' if res['within_budget'] else 'OVER'})")
+        try:
+            import PySide6  # noqa: F401
+        except ImportError:
+            print("startup ui: PySide6 not installed, skipped")
+            return results
+        samples, inner = [], []
+        cmd = [sys.executable, __file__, "--child", "ui_paint", "--dir", tmp]
+        for _ in range(repeat):
+            t = time.perf_counter()
+            res = subprocess.run(cmd, env=env, capture_output=True, text=True)
+            samples.append(time.perf_counter() - t)
+            if res.returncode != 0:
+                raise RuntimeError(f"ui paint child failed:\n{res.stderr}")
+            inner.append(json.loads(res.stdout.strip().splitlines()[-1]))
+        ui = percentiles(samples)
+        for k in inner[0]:
+            ui[k] = sorted(r[k] for r in inner)[len(inner) // 2]
+        results["ui_first_paint"] = ui
+        print(f"startup ui first paint      {ui['in_process_ms']:7.1f} ms in process (import {ui['import_ms']:.1f},"
+              f" init {ui['init_ms']:.1f}, paint {ui['paint_ms']:.1f}); {ui['p50_ms']:.1f} ms process wall")
+    return results
+
+def _flatten(d, prefix=""):
+    out = {}
+    for k, v in d.items():
+        if isinstance(v, dict):
+            out.update(_flatten(v, f"{prefix}{k}."))
+        elif isinstance(v, (int, float)) and not isinstance(v, bool):
+            out[prefix + k] = v
+    return out
+
+def compare(old_path: str, new_path: str):
+    old = _flatten(json.loads(Path(old_path).read_text())["results"])
+    new = _flatten(json.loads(Path(new_path).read_text())["results"])
+    for k in sorted(old.keys() & new.keys()):
+        if k.endswith(".n") or not old[k]:
+            continue
+        print(f"{k:55s} {old[k]:12.3f} -> {new[k]:12.3f}  ({new[k] / old[k]:6.2f}x)")
+
+def main():
+    ap = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    ap.add_argument("--scenario", action="append", choices=sorted(SCENARIOS),
+                    help="scenario to run (repeatable; default all)")
+    ap.add_argument("--scale", type=float, default=1.0, help="multiply file counts and repetitions")
+    ap.add_argument("--out", help="write JSON results here")
+    ap.add_argument("--workdir", help="where to create the temp HOME/mount (default: system temp)")
+    ap.add_argument("--startup", action="store_true", help="only measure CLI cold start and UI first paint")
+    ap.add_argument("--compare", nargs=2, metavar=("OLD", "NEW"), help="diff two result files")
+    ap.add_argument("--child", nargs=1, help=argparse.SUPPRESS)
+    ap.add_argument("--dir", help=argparse.SUPPRESS)
+    args = ap.parse_args()
+
+    if args.compare:
+        compare(*args.compare)
+        return
+    if args.child:
+        phase = args.child[0]
+        bench_dir = Path(args.dir)
+        if phase == "micro":
+            res = child_micro(bench_dir, args.scale)
+        elif phase == "ui_paint":
+            res = child_ui_paint()
+        else:
+            res = child_phase(phase, bench_dir, args.scenario[0], args.scale)
+        print(json.dumps(res))
+        return
+
+    if args.startup:
+        results = {"startup": run_startup(args.scale, args.workdir)}
+    else:
+        results = run_all(args.scenario or list(SCENARIOS), args.scale, args.workdir)
+        results["startup"] = run_startup(args.scale, args.workdir)
+    report = {
+        "created": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "scale": args.scale,
+        "machine": {"platform": platform.platform(), "python": platform.python_version(),
+                    "cpus": os.cpu_count()},
+        "results": results,
+    }
+    if args.out:
+        Path(args.out).write_text(json.dumps(report, indent=2, sort_keys=True))
+        print("Results written to", args.out)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,180 @@
+#!/usr/bin/env python3
+"""
+Long-lived cloak daemon: runs cloak_manager CLI commands for thin clients.
+
+A plain `cloak_manager.py <command>` pays for interpreter startup, the crypto
+imports, opening meta.db, scanning drives and deriving the key on every run.
+The daemon pays that once and keeps it warm: the drive registry, the unlocked
+key cache (still bounded by KEY_CACHE_TTL, and dropped for a token as soon as
+its USB is removed) and the metadata connections stay in this process. While
+it runs, the CLI forwards each command here over a Unix socket in ~/.safekey
+(mode 0600, same uid only) and relays output and password prompts; without it
+the CLI runs commands in-process as before.
+
+  python cloak_daemon.py          # serve in the foreground
+  python cloak_daemon.py stop
+"""
+
+import os
+import io
+import sys
+import json
+import struct
+import socket
+import threading
+import contextvars
+import socketserver
+
+import cloak_manager as sk
+
+class _ThreadStdout(io.TextIOBase):
+    """
+    sys.stdout stand-in: a request prints to its client, anything else to the
+    real stdout. The client is looked up in a contextvar rather than a
+    thread-local so the pool workers of a command (submitted via sk._submit,
+    which copies the context) print to the same client.
+    """
+    def __init__(self, real):
+        self.real = real
+        self.send = contextvars.ContextVar("cloak_client_send", default=None)
+
+    def write(self, s):
+        send = self.send.get()
+        if send is None:
+            return self.real.write(s)
+        send({"out": s})
+        return len(s)
+
+    def flush(self):
+        if self.send.get() is None:
+            self.real.flush()
+
+class _Handler(socketserver.StreamRequestHandler):
+    def handle(self):
+        self.send_lock = threading.Lock()
+        if not self._same_user():
+            return
+        line = self.rfile.readline()
+        if not line:
+            return
+        req = json.loads(line)
+        if req.get("stop"):
+            self._send({"exit": 0})
+            threading.Thread(target=self.server.shutdown, daemon=True).start()
+            return
+        stdout = self.server.stdout
+        client = stdout.send.set(self._send)
+        sk._cli_io.prompt = self._prompt
+        sk._cli_io.cwd = req.get("cwd")
+        try:
+            # commands run one at a time, as they would from a single terminal
+            with self.server.run_lock:
+                code = sk.main(req["argv"])
+        except SystemExit as e:
+            code = e.code if isinstance(e.code, int) else 1
+        except (EOFError, BrokenPipeError, ConnectionResetError):
+            return  # client went away (e.g. Ctrl-C at a prompt)
+        except Exception as e:
+            print("Error:", e)
+            code = 1
+        finally:
+            stdout.send.reset(client)
+            sk._cli_io.prompt = None
+            sk._cli_io.cwd = None
+        try:
+            self._send({"exit": code})
+        except OSError:
+            pass
+
+    def _same_user(self) -> bool:
+        try:
+            cred = self.request.getsockopt(socket.SOL_SOCKET, socket.SO_PEERCRED, struct.calcsize("3i"))
+        except (AttributeError, OSError):
+            return True  # no SO_PEERCRED here; the 0600 socket is the only guard
+        return struct.unpack("3i", cred)[1] == os.getuid()
+
+    def _send(self, msg: dict):
+        with self.send_lock:  # pool workers print concurrently
+            self.wfile.write(json.dumps(msg).encode() + b"\n")
+            self.wfile.flush()
+
+    def _prompt(self, text: str) -> str:
+        self._send({"prompt": text})
+        line = self.rfile.readline()
+        if not line:
+            raise EOFError
+        return json.loads(line)["answer"]
+
+class CloakDaemon(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+    def __init__(self, path=sk.DAEMON_SOCKET):
+        self.run_lock = threading.Lock()
+        self.stdout = _ThreadStdout(sys.stdout)
+        old = os.umask(0o177)
+        try:
+            super().__init__(str(path), _Handler)
+        finally:
+            os.umask(old)
+        self.path = path
+
+    def server_close(self):
+        super().server_close()
+        try:
+            os.unlink(self.path)
+        except FileNotFoundError:
+            pass
+
+def _daemon_running() -> bool:
+    s = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        s.connect(str(sk.DAEMON_SOCKET))
+        return True
+    except OSError:
+        return False
+    finally:
+        s.close()
+
+def _drop_keys_on_removal():
+    """Zeroize the cached keys of a token once its USB is gone, as the UI and the poller do."""
+    for event, tok, mount in sk.watch_tokens():
+        if event == "remove":
+            sk.clear_key_cache(tok)
+            print("USB removed from", mount, "- dropped cached keys of", tok)
+
+def serve():
+    sk.ensure_dirs()
+    if _daemon_running():
+        print("cloak daemon already running at", sk.DAEMON_SOCKET)
+        return 1
+    sk.DAEMON_SOCKET.unlink(missing_ok=True)  # stale socket of a daemon that died
+    server = CloakDaemon()
+    sys.stdout = server.stdout
+    sk.list_all_usb_drives()  # warm the drive registry
+    threading.Thread(target=_drop_keys_on_removal, name="usb-removal", daemon=True).start()
+    print("cloak daemon listening on", sk.DAEMON_SOCKET)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        sk.clear_key_cache()
+        sys.stdout = server.stdout.real
+    return 0
+
+def stop():
+    if not _daemon_running():
+        print("cloak daemon is not running")
+        return 1
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as s:
+        s.connect(str(sk.DAEMON_SOCKET))
+        s.sendall(json.dumps({"stop": True}).encode() + b"\n")
+        s.recv(64)
+    print("cloak daemon stopped")
+    return 0
+
+if __name__ == "__main__":
+    if len(sys.argv) > 1 and sys.argv[1] != "stop":
+        print("usage: cloak_daemon.py [stop]"); sys.exit(1)
+    sys.exit(stop() if len(sys.argv) > 1 else serve())
@@ -0,0 +1,288 @@
+#!/usr/bin/env python3
+"""
+Read-only FUSE view of a token's vault (optional; needs the fusepy package).
+
+Instead of writing every item back to its original path like reveal does, the
+vault's original tree is presented under a mountpoint and file contents are
+decrypted piece by piece (one stream record or dedup chunk) when read.
+Decrypted pieces live only in a bounded in-memory LRU cache; nothing plaintext
+is written to disk, and unmounting leaves nothing to hide.
+
+  python cloak_fuse.py <token> <mountpoint>
+"""
+
+import os
+import sys
+import stat
+import time
+import errno
+import bisect
+import getpass
+import threading
+from collections import OrderedDict
+from pathlib import Path
+
+import cloak_manager as sk
+
+try:
+    from fuse import FUSE, Operations, FuseOSError
+except ImportError:  # fusepy is optional
+    FUSE = None
+    Operations = object
+
+    def FuseOSError(code):
+        return OSError(code, os.strerror(code))
+
+# plaintext cache budget in MiB (SAFEKEY_FUSE_CACHE_MB)
+CACHE_BYTES = int(os.environ.get("SAFEKEY_FUSE_CACHE_MB", "64")) * 1024 * 1024
+# legacy single-message blobs are served in windows of this many plaintext bytes
+LEGACY_WINDOW = 8 * 1024 * 1024
+
+class PlainCache:
+    """LRU of decrypted pieces, bounded by total plaintext bytes (larger pieces are not kept)."""
+    def __init__(self, max_bytes: int = CACHE_BYTES):
+        self.max_bytes = max_bytes
+        self.size = 0
+        self._lock = threading.Lock()
+        self._data = OrderedDict()
+
+    def get(self, k):
+        with self._lock:
+            v = self._data.get(k)
+            if v is not None:
+                self._data.move_to_end(k)
+            return v
+
+    def put(self, k, v: bytes):
+        with self._lock:
+            old = self._data.pop(k, None)
+            if old is not None:
+                self.size -= len(old)
+            if len(v) > self.max_bytes:
+                return
+            self._data[k] = v
+            self.size += len(v)
+            while self.size > self.max_bytes:
+                self.size -= len(self._data.popitem(last=False)[1])
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+            self.size = 0
+
+class _Pieces:
+    """
+    Where an item's plaintext comes from: starts[i] is the plaintext offset of
+    piece i and load(i) decrypts it. Built on first access to the file.
+    """
+    def __init__(self, key: bytes, item: dict):
+        self.key = key
+        self.item = item
+        self.first = None  # piece decrypted while indexing, handed to the cache
+        if item.get("fmt") == sk.DEDUP_FORMAT:
+            self._index_chunks()
+        elif "seg" in item or item.get("fmt") == sk.STREAM_FORMAT:
+            self._index_stream()
+        else:
+            # one AES-GCM message: nonce + ciphertext + tag, split into windows read by load()
+            self.path = sk.VAULT_DIR / item["vault"]
+            self.size = self.path.stat().st_size - 28
+            self.starts = list(range(0, max(self.size, 1), LEGACY_WINDOW))
+
+    def _index_chunks(self):
+        self.starts = []
+        pos = 0
+        for cid in self.item["chunks"]:
+            self.starts.append(pos)
+            pos += sk._chunk_path(cid).stat().st_size - 28  # nonce + tag
+        self.size = pos
+
+    def _index_stream(self):
+        if "seg" in self.item:
+            f = sk._segment_file(self.item)  # updates item if compaction moved its slot
+            self.path = sk.SEGMENTS_DIR / self.item["seg"]
+            off, end = self.item["off"], self.item["off"] + self.item["len"]
+        else:
+            self.path = sk.VAULT_DIR / self.item["vault"]
+            f = open(self.path, "rb")
+            off, end = 0, None
+        with f:
+            f.seek(off)
+            self.header, self.records = sk.stream_records(f, end)
+        chunk_size = int.from_bytes(self.header[4:8], "big")
+        self.starts = [i * chunk_size for i in range(len(self.records))]
+        if "size" in self.item:
+            self.size = self.item["size"]
+        elif not self.item.get("codec"):
+            self.size = sum(length - 16 for _, length, _ in self.records)  # ciphertext = plaintext + tag
+        else:
+            # sealed before sizes were recorded: every chunk but the last is full
+            last = self.load(len(self.records) - 1)
+            self.size = self.starts[-1] + len(last)
+            self.first = (len(self.records) - 1, last)
+
+    def piece_at(self, offset: int) -> int:
+        return bisect.bisect_right(self.starts, offset) - 1
+
+    def load(self, i: int) -> bytes:
+        if self.item.get("fmt") == sk.DEDUP_FORMAT:
+            return sk.decrypt_blob(self.key, sk._chunk_path(self.item["chunks"][i]).read_bytes())
+        if not hasattr(self, "records"):
+            return self._load_window(i)
+        try:
+            f = open(self.path, "rb")
+        except FileNotFoundError:
+            # segment compacted since indexing: re-index at the slot's new location
+            if "seg" not in self.item or not sk._follow_segment(self.item):
+                raise
+            self._index_stream()
+            f = open(self.path, "rb")
+        pos, length, last = self.records[i]
+        with f:
+            f.seek(pos)
+            ct = f.read(length)
+        return sk.decrypt_stream_record(self.key, self.header, i, last, ct, self.item.get("codec"))
+
+    def _load_window(self, i: int) -> bytes:
+        """
+        Plaintext window i of a legacy blob. The whole message is decrypted in
+        passing (it only authenticates at its end) but only the window is kept.
+        """
+        from cryptography.hazmat.primitives.ciphers import Cipher, algorithms, modes
+        lo = self.starts[i]
+        hi = min(lo + LEGACY_WINDOW, self.size)
+        out = []
+        with open(self.path, "rb") as f:
+            nonce = f.read(12)
+            f.seek(-16, os.SEEK_END)
+            tag = f.read(16)
+            f.seek(12)
+            dec = Cipher(algorithms.AES(self.key), modes.GCM(nonce, tag)).decryptor()
+            pos = 0
+            while pos < self.size:
+                block = dec.update(f.read(min(sk.STREAM_CHUNK_SIZE, self.size - pos)))
+                if pos + len(block) > lo and pos < hi:
+                    out.append(block[max(0, lo - pos):hi - pos])
+                pos += len(block)
+            dec.finalize()  # InvalidTag if any of it was tampered with
+        return b"".join(out)
+
+class VaultFS(Operations):
+    """fusepy operations serving one vault's items read-only at their original paths."""
+    def __init__(self, vault: str, key: bytes, cache: PlainCache = None):
+        self.token = vault
+        self.key = key
+        self.cache = cache or PlainCache()
+        self.files = {}        # "/orig/path" -> item
+        self.dirs = {"/": set()}
+        self.pieces = {}       # item id -> _Pieces
+        self._lock = threading.Lock()
+        self.mounted_at = time.time()
+        for item in sk.list_items(vault):
+            self._add(item)
+
+    def _add(self, item: dict):
+        path = "/" + Path(item["orig"]).as_posix().lstrip("/")
+        self.files[path] = item
+        child = path
+        parent = os.path.dirname(child)
+        while True:
+            kids = self.dirs.setdefault(parent, set())
+            kids.add(os.path.basename(child))
+            if parent == "/":
+                break
+            child, parent = parent, os.path.dirname(parent)
+
+    def _pieces(self, item: dict) -> _Pieces:
+        with self._lock:
+            p = self.pieces.get(item["id"])
+        if p is None:
+            try:
+                p = _Pieces(self.key, item)
+            except FileNotFoundError:
+                raise FuseOSError(errno.ENOENT)
+            except Exception:
+                raise FuseOSError(errno.EIO)  # failed authentication
+            if p.first is not None:
+                self.cache.put((item["id"], p.first[0]), p.first[1])
+                p.first = None
+            with self._lock:
+                self.pieces[item["id"]] = p
+        return p
+
+    def _piece(self, item: dict, pieces: _Pieces, i: int) -> bytes:
+        data = self.cache.get((item["id"], i))
+        if data is None:
+            try:
+                data = pieces.load(i)
+            except Exception:
+                raise FuseOSError(errno.EIO)
+            self.cache.put((item["id"], i), data)
+        return data
+
+    def getattr(self, path, fh=None):
+        base = {"st_uid": os.getuid(), "st_gid": os.getgid(), "st_atime": self.mounted_at,
+                "st_mtime": self.mounted_at, "st_ctime": self.mounted_at}
+        if path in self.dirs:
+            return dict(base, st_mode=stat.S_IFDIR | 0o500, st_nlink=2)
+        item = self.files.get(path)
+        if item is None:
+            raise FuseOSError(errno.ENOENT)
+        # recorded at seal time, so listing a directory decrypts nothing
+        size = item["size"] if "size" in item else self._pieces(item).size
+        return dict(base, st_mode=stat.S_IFREG | 0o400, st_nlink=1, st_size=size)
+
+    def readdir(self, path, fh):
+        if path not in self.dirs:
+            raise FuseOSError(errno.ENOTDIR)
+        return [".", ".."] + sorted(self.dirs[path])
+
+    def open(self, path, flags):
+        if path not in self.files:
+            raise FuseOSError(errno.ENOENT)
+        if flags & (os.O_WRONLY | os.O_RDWR | os.O_APPEND | os.O_TRUNC):
+            raise FuseOSError(errno.EROFS)
+        return 0
+
+    def read(self, path, size, offset, fh):
+        item = self.files.get(path)
+        if item is None:
+            raise FuseOSError(errno.ENOENT)
+        pieces = self._pieces(item)
+        end = min(offset + size, pieces.size)
+        out = []
+        pos = offset
+        while pos < end:
+            i = pieces.piece_at(pos)
+            data = self._piece(item, pieces, i)
+            start = pos - pieces.starts[i]
+            part = data[start:start + end - pos]
+            if not part:
+                break
+            out.append(part)
+            pos += len(part)
+        return b"".join(out)
+
+    def destroy(self, path):
+        self.cache.clear()
+        for tok in sk.vault_tokens(self.token):
+            sk.clear_key_cache(tok)
+
+def mount_vault(token_str: str, password: str, mountpoint: str, foreground: bool = True):
+    """Serve token_str's vault read-only at mountpoint until it is unmounted."""
+    if FUSE is None:
+        raise RuntimeError("FUSE view needs the 'fusepy' package (and libfuse)")
+    key = sk._unlock(token_str, password)
+    if key is None:
+        raise ValueError("Unknown token or wrong password")
+    FUSE(VaultFS(sk.vault_of(token_str), key), mountpoint, foreground=foreground, ro=True, nothreads=False)
+
+if __name__ == "__main__":
+    if len(sys.argv) != 3:
+        print("usage: cloak_fuse.py <token> <mountpoint>"); sys.exit(1)
+    sk.ensure_dirs()
+    pwd = getpass.getpass("Enter master password: ")
+    try:
+        mount_vault(sys.argv[1], pwd, sys.argv[2])
+    except (RuntimeError, ValueError) as e:
+        print(e); sys.exit(1)
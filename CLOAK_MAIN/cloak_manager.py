@@ -3,59 +3,1458 @@
 SafeKey / Cloak manager prototype (modified)
 - Provides old detect_mounted_tokens() for backward compat
 - Adds list_all_usb_drives() to list all connected removable drives, with token info
-Other core behaviors unchanged (provision, assign, reveal, hide, poll)
+  (cached in a drive registry, rescanned only when the mount table changes)
+- Vault blobs are written in a chunked streaming format (flat memory for any file size)
+- Metadata lives in an indexed SQLite store (~/.safekey/meta.db); meta.json is migrated once
+- Optional deduplicating chunk store (SAFEKEY_DEDUP=1) shares identical content within a token (content-defined cuts need numpy; without it chunks are fixed-size)
+- Optional per-chunk compression before encryption (SAFEKEY_COMPRESS=zstd|lz4|zlib)
+- Small files are packed into append-only segment files, compacted in the background
+- One vault entry per original path; reveal/hide can target a single path or subtree
+- assign/hide keep a per-file journal in meta.db; an interrupted batch is settled on the next run
+- gc removes unreferenced vault storage (compaction throttled to SAFEKEY_GC_MBPS); scrub verifies AES-GCM tags incrementally (health.json)
+- Timing spans and counters per operation, exported via SAFEKEY_METRICS (JSON lines / Prometheus)
+- Envelope keys: a random per-vault data key wrapped per token, so passwd/addbackup/replace
+  never re-encrypt the vault
+- Token KEKs use a per-token KDF (argon2id/scrypt/pbkdf2) calibrated to SAFEKEY_KDF_MS here;
+  older parameters are upgraded on the next successful unlock
+- cloak_fuse.py can serve a vault read-only over FUSE, decrypting on read instead of revealing
+- poll runs reveal/hide jobs for different tokens concurrently (serialized per vault) with
+  non-blocking prompts; pulling a key cancels its pending reveal
+- Heavy imports (psutil, cryptography, ...) are deferred to first use for fast CLI/UI startup
+- cloak_daemon.py keeps keys, drive registry and metadata warm; while it runs the CLI is a thin
+  client over a Unix socket (in-process otherwise, or with SAFEKEY_DAEMON=0)
+Other core behaviors unchanged (provision, assign, reveal, hide)
 """
 
 import os
 import sys
 import json
 import time
-import uuid
 import secrets
-import shutil
-import tempfile
 import platform
+import select
+import struct
+import random
+import zlib
+import io
+import mmap
+import hmac
+import hashlib
+import math
+import threading
+import queue
+import sqlite3
+import contextlib
+import contextvars
+import re
+try:
+    import fcntl
+except ImportError:  # Windows: segment files are not locked between processes
+    fcntl = None
+from collections import deque
 from pathlib import Path
 import base64
-import getpass
-import psutil
-from cryptography.hazmat.primitives.kdf.pbkdf2 import PBKDF2HMAC
-from cryptography.hazmat.primitives import hashes
-from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+# psutil, cryptography, concurrent.futures, getpass, socket, uuid and ctypes are
+# imported where first needed, so usage errors, listdrives, the daemon client and
+# the UI's first paint don't pay for loading them (see bench_cloak.py --startup)
 
 APP_DIR = Path.home() / ".safekey"
 VAULT_DIR = APP_DIR / "vault"
-META_FILE = APP_DIR / "meta.json"
+META_FILE = APP_DIR / "meta.json"  # legacy store, migrated into META_DB on first use
+META_DB = APP_DIR / "meta.db"
+# the kernel flags this file with POLLPRI whenever the mount table changes
+MOUNTINFO = "/proc/self/mountinfo"
+# rescan interval where mount events are unavailable (non-Linux)
+POLL_INTERVAL = 2.0
+
+# vault blob formats recorded per item in meta ("fmt"); items without it are legacy
+# single-message blobs (nonce + ciphertext) written by older versions
+STREAM_FORMAT = "stream1"
+STREAM_MAGIC = b"SKS1"
+STREAM_CHUNK_SIZE = 1024 * 1024
+DEDUP_FORMAT = "dedup1"
+CHUNKS_DIR = VAULT_DIR / "chunks"
+SEGMENTS_DIR = VAULT_DIR / "segments"
+
+# compression codec applied per stream chunk before encryption: "zstd", "lz4",
+# "zlib" or "" (off). zstd/lz4 need the zstandard/lz4 packages.
+COMPRESS = os.environ.get("SAFEKEY_COMPRESS", "")
+# files a quick probe shows to be already compressed are stored raw
+INCOMPRESSIBLE_SUFFIXES = {
+    ".jpg", ".jpeg", ".png", ".gif", ".webp", ".heic", ".mp3", ".aac", ".ogg", ".flac",
+    ".mp4", ".mkv", ".mov", ".avi", ".webm", ".zip", ".gz", ".tgz", ".bz2", ".xz",
+    ".zst", ".lz4", ".7z", ".rar", ".pdf", ".docx", ".xlsx", ".pptx", ".jar", ".apk",
+}
+
+# files up to this size are packed into append-only segment files instead of
+# getting a vault file each; a segment is closed once it reaches SEGMENT_MAX
+SMALL_FILE_LIMIT = 64 * 1024
+SEGMENT_MAX = 64 * 1024 * 1024
+# compaction rewrites segments whose live bytes fall below this fraction
+COMPACT_THRESHOLD = 0.5
+
+# secure delete overwrites through one reusable buffer of this size per pass
+WIPE_BUFFER = 1024 * 1024
+# overwrite passes: byte values to fill with, or "random"
+WIPE_PASSES = (b"\x00",)
+# punch holes / use O_DIRECT instead of a buffered overwrite where supported
+WIPE_FAST = os.environ.get("SAFEKEY_WIPE_FAST") == "1"
+
+# content-defined chunk sizes for dedup mode (CDC_AVG must be a power of two)
+CDC_MIN = 16 * 1024
+CDC_AVG = 64 * 1024
+CDC_MAX = 256 * 1024
+# assign new files in dedup mode unless the caller says otherwise
+DEDUP = os.environ.get("SAFEKEY_DEDUP") == "1"
+
+# worker threads for the encrypt/decrypt pipeline (AES-GCM and file I/O release the GIL)
+WORKERS = int(os.environ.get("SAFEKEY_WORKERS", "0")) or min(32, os.cpu_count() or 1)
+# metadata rows committed per transaction during bulk assign
+ASSIGN_BATCH = 256
+
+# hide re-reads unchanged revealed files to compare a content hash, on top of
+# the size/mtime/inode fingerprint check
+HIDE_VERIFY_HASH = os.environ.get("SAFEKEY_HIDE_VERIFY_HASH") == "1"
+
+# stream sources at least this big are mmap'ed and fed to AES-GCM as memoryview
+# slices instead of being read() into fresh bytes per chunk
+MMAP_MIN = 1024 * 1024
+MMAP_READS = os.environ.get("SAFEKEY_MMAP", "1") != "0"
+
+# derived keys stay cached in-process for this long after their last use
+KEY_CACHE_TTL = 15 * 60
+
+# KDF for token KEKs ("argon2id", "scrypt" or "pbkdf2") and the unlock time its
+# cost is calibrated to on this machine; the result is kept in KDF_CALIBRATION
+KDF_NAME = os.environ.get("SAFEKEY_KDF", "")  # default: argon2id where available, else scrypt
+KDF_TARGET_MS = float(os.environ.get("SAFEKEY_KDF_MS", "500"))
+KDF_CALIBRATION = APP_DIR / "kdf.json"
+# keys from before per-token KDF parameters were PBKDF2-SHA256 at this cost
+LEGACY_KDF = {"name": "pbkdf2", "iterations": 200_000}
+
+# gc leaves unreferenced vault files younger than this alone (writes in flight)
+GC_GRACE = 10 * 60
+# scrub reads at most this many MB/s of vault data (0 = unthrottled), and by
+# default checks up to SCRUB_BUDGET_MB per run, least recently checked first
+SCRUB_MBPS = float(os.environ.get("SAFEKEY_SCRUB_MBPS", "50"))
+SCRUB_BUDGET_MB = float(os.environ.get("SAFEKEY_SCRUB_BUDGET_MB", "1024"))
+# gc copies live segment slots at most this fast while compacting (0 = unthrottled)
+GC_MBPS = float(os.environ.get("SAFEKEY_GC_MBPS", str(SCRUB_MBPS)))
+HEALTH_FILE = APP_DIR / "health.json"
+
+# where operation metrics go: "jsonl:<path>" (one record per operation),
+# "prom:<path>" (Prometheus textfile, rewritten after each operation), comma-separated
+METRICS_SINKS = os.environ.get("SAFEKEY_METRICS", "")
+
+# cloak_daemon listens here; the CLI hands commands to it when it is running
+# (SAFEKEY_DAEMON=0 always runs them in-process)
+DAEMON_SOCKET = APP_DIR / "daemon.sock"
+USE_DAEMON = os.environ.get("SAFEKEY_DAEMON", "1") != "0"
 
 # --- util ---
 def ensure_dirs():
     APP_DIR.mkdir(parents=True, exist_ok=True)
     VAULT_DIR.mkdir(parents=True, exist_ok=True)
+    CHUNKS_DIR.mkdir(parents=True, exist_ok=True)
+    SEGMENTS_DIR.mkdir(parents=True, exist_ok=True)
+
+# --- instrumentation ---
+# Process-wide timing spans (count, seconds) and counters. Hot paths record into
+# `metrics`; assign/reveal/hide/scrub run inside metrics.operation(), which hands
+# each sink a record with that operation's own spans and counters plus the
+# running totals. An operation's scope lives in a contextvar (worker jobs are
+# submitted with _submit() so they inherit it), so overlapping operations on
+# other threads don't leak into each other's records.
+# A sink is any callable taking that dict; see add_metrics_sink().
+_op_scope = contextvars.ContextVar("metrics_op_scope", default=None)
+
+class Metrics:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.spans = {}     # name -> [count, seconds]
+        self.counters = {}  # name -> value
+        self.sinks = []
+
+    def observe(self, name: str, seconds: float):
+        scope = _op_scope.get()
+        with self._lock:
+            for spans in self._span_tables(scope):
+                s = spans.get(name)
+                if s is None:
+                    s = spans[name] = [0, 0.0]
+                s[0] += 1
+                s[1] += seconds
+
+    def add(self, name: str, n: int = 1):
+        scope = _op_scope.get()
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + n
+            while scope is not None:
+                scope["counters"][name] = scope["counters"].get(name, 0) + n
+                scope = scope["parent"]
+
+    def _span_tables(self, scope):
+        yield self.spans
+        while scope is not None:  # an operation nested in another counts for both
+            yield scope["spans"]
+            scope = scope["parent"]
+
+    @contextlib.contextmanager
+    def span(self, name: str):
+        t = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - t)
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            return {"spans": {k: list(v) for k, v in self.spans.items()}, "counters": dict(self.counters)}
+
+    @contextlib.contextmanager
+    def operation(self, op: str, **attrs):
+        scope = {"spans": {}, "counters": {}, "parent": _op_scope.get()}
+        token = _op_scope.set(scope)
+        t = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe("op." + op, time.perf_counter() - t)
+            _op_scope.reset(token)
+            if self.sinks:
+                self._emit(op, attrs, scope, time.perf_counter() - t)
+
+    def _emit(self, op: str, attrs: dict, scope: dict, seconds: float):
+        with self._lock:
+            spans = {k: {"count": n, "seconds": round(s, 6)} for k, (n, s) in scope["spans"].items()}
+            counters = dict(scope["counters"])
+        record = {"ts": time.time(), "op": op, "seconds": round(seconds, 6), **attrs,
+                  "spans": spans, "counters": counters, "totals": self.snapshot()}
+        for sink in list(self.sinks):
+            try:
+                sink(record)
+            except Exception as e:  # metrics must never break the operation
+                print("Metrics sink failed:", e)
+
+metrics = Metrics()
+
+def jsonl_sink(path):
+    """Append one JSON line per operation (totals left out; they're the records' sum)."""
+    path = Path(path)
+    lock = threading.Lock()
+
+    def sink(record):
+        line = json.dumps({k: v for k, v in record.items() if k != "totals"})
+        with lock, open(path, "a") as f:
+            f.write(line + "\n")
+    return sink
+
+def prometheus_sink(path):
+    """Rewrite a node_exporter textfile with the running totals after each operation."""
+    path = Path(path)
+
+    def sink(record):
+        totals = record["totals"]
+        lines = [
+            "# TYPE safekey_span_seconds_total counter",
+            *(f'safekey_span_seconds_total{{span="{k}"}} {v[1]:.6f}' for k, v in sorted(totals["spans"].items())),
+            "# TYPE safekey_span_count_total counter",
+            *(f'safekey_span_count_total{{span="{k}"}} {v[0]}' for k, v in sorted(totals["spans"].items())),
+            "# TYPE safekey_events_total counter",
+            *(f'safekey_events_total{{name="{k}"}} {v}' for k, v in sorted(totals["counters"].items())),
+            "# TYPE safekey_last_operation_timestamp_seconds gauge",
+            f'safekey_last_operation_timestamp_seconds{{op="{record["op"]}"}} {record["ts"]:.3f}',
+        ]
+        tmp = path.with_name(f".{path.name}.{os.getpid()}.tmp")
+        tmp.write_text("\n".join(lines) + "\n")
+        os.replace(tmp, path)
+    return sink
+
+def add_metrics_sink(sink):
+    metrics.sinks.append(sink)
+
+def _sinks_from_env(spec: str):
+    for part in filter(None, (p.strip() for p in spec.split(","))):
+        kind, _, target = part.partition(":")
+        if kind == "jsonl":
+            add_metrics_sink(jsonl_sink(target))
+        elif kind == "prom":
+            add_metrics_sink(prometheus_sink(target))
+        else:
+            print("Unknown SAFEKEY_METRICS sink:", part)
+
+_sinks_from_env(METRICS_SINKS)
+
+# --- metadata store ---
+# SQLite in WAL mode. Items have a unique (token, orig) index: one live entry per
+# original path, point lookups by path, and subtree queries as index range scans.
+# Item attributes other than vault/orig (e.g. "fmt") live in the JSON "info" column.
+_META_SCHEMA = """
+CREATE TABLE IF NOT EXISTS tokens (
+    token TEXT PRIMARY KEY,
+    salt  TEXT NOT NULL,
+    vault TEXT,
+    kek   TEXT
+);
+CREATE TABLE IF NOT EXISTS items (
+    id    INTEGER PRIMARY KEY,
+    token TEXT NOT NULL,
+    orig  TEXT NOT NULL,
+    vault TEXT NOT NULL,
+    info  TEXT NOT NULL DEFAULT '{}'
+);
+CREATE TABLE IF NOT EXISTS chunks (
+    token TEXT NOT NULL,
+    id    TEXT NOT NULL,
+    refs  INTEGER NOT NULL,
+    PRIMARY KEY (token, id)
+);
+CREATE TABLE IF NOT EXISTS journal (
+    id     INTEGER PRIMARY KEY,
+    op     TEXT NOT NULL,
+    token  TEXT NOT NULL,
+    path   TEXT NOT NULL,
+    state  TEXT NOT NULL,
+    owner  TEXT NOT NULL,
+    plan   TEXT NOT NULL DEFAULT '{}',
+    sealed TEXT
+);
+CREATE INDEX IF NOT EXISTS journal_by_token ON journal(token);
+CREATE TABLE IF NOT EXISTS health (
+    item    INTEGER PRIMARY KEY,
+    token   TEXT NOT NULL,
+    checked REAL NOT NULL,
+    status  TEXT NOT NULL
+);
+"""
+
+_db_local = threading.local()
+
+def _db() -> sqlite3.Connection:
+    """Per-thread connection to META_DB (autocommit; use meta_batch() for transactions)."""
+    conn = getattr(_db_local, "conn", None)
+    if conn is None:
+        ensure_dirs()
+        conn = sqlite3.connect(META_DB, isolation_level=None, timeout=30)
+        conn.row_factory = sqlite3.Row
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        conn.executescript(_META_SCHEMA)
+        _db_local.conn = conn
+        _db_local.depth = 0
+        _migrate_json_meta(conn)
+        _migrate_unique_orig(conn)
+        _migrate_envelope(conn)
+    return conn
+
+@contextlib.contextmanager
+def meta_batch():
+    """Group metadata writes into one transaction. Nested uses join the outer one."""
+    conn = _db()
+    if _db_local.depth == 0:
+        conn.execute("BEGIN IMMEDIATE")
+    _db_local.depth += 1
+    try:
+        yield conn
+    except BaseException:
+        _db_local.depth -= 1
+        if _db_local.depth == 0:
+            conn.execute("ROLLBACK")
+        raise
+    _db_local.depth -= 1
+    if _db_local.depth == 0:
+        conn.execute("COMMIT")
+
+def _migrate_json_meta(conn: sqlite3.Connection):
+    """One-time import of the old meta.json layout; the JSON file is kept as meta.json.migrated."""
     if not META_FILE.exists():
-        META_FILE.write_text(json.dumps({}))
+        return
+    old = json.loads(META_FILE.read_text() or "{}")
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        for token_str, ent in old.items():
+            conn.execute("INSERT OR IGNORE INTO tokens(token, salt) VALUES (?, ?)", (token_str, ent["salt"]))
+            for item in ent.get("items", []):
+                _insert_item(conn, token_str, item)
+        conn.execute("COMMIT")
+    except BaseException:
+        conn.execute("ROLLBACK")
+        raise
+    META_FILE.rename(META_FILE.with_name(META_FILE.name + ".migrated"))
+    print("Migrated", META_FILE, "to", META_DB)
+
+def _migrate_unique_orig(conn: sqlite3.Connection):
+    """
+    Schema v1: replace the plain (token, orig) index with a unique one.
+    Older stores could hold several entries per path (assigned twice); the
+    newest entry wins and the vault storage of the others is released.
+    """
+    if conn.execute("PRAGMA user_version").fetchone()[0] >= 1:
+        return
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        if conn.execute("PRAGMA user_version").fetchone()[0] >= 1:
+            conn.execute("COMMIT")
+            return
+        rows = conn.execute(
+            "SELECT * FROM items WHERE id NOT IN (SELECT max(id) FROM items GROUP BY token, orig)"
+        ).fetchall()
+        stale = [(r["token"], _row_to_item(r)) for r in rows]
+        for token_str, item in stale:
+            if item.get("fmt") == DEDUP_FORMAT:
+                ref_chunks(token_str, item["chunks"], -1)
+        conn.executemany("DELETE FROM items WHERE id = ?", [(item["id"],) for _, item in stale])
+        dead = [cid for token_str in {t for t, _ in stale} for cid in pop_dead_chunks(token_str)]
+        conn.execute("DROP INDEX IF EXISTS items_by_orig")
+        conn.execute("CREATE UNIQUE INDEX IF NOT EXISTS items_orig ON items(token, orig)")
+        conn.execute("PRAGMA user_version = 1")
+        conn.execute("COMMIT")
+    except BaseException:
+        conn.execute("ROLLBACK")
+        raise
+    if stale:
+        _release_storage([item for _, item in stale], dead)
+        print(f"Dropped {len(stale)} duplicate vault entries")
+
+def _migrate_envelope(conn: sqlite3.Connection):
+    """
+    Schema v2: tokens get "vault" (the vault id whose items they unlock, NULL for
+    their own) and "kek" (the wrapped data key, set on first unlock).
+    """
+    if conn.execute("PRAGMA user_version").fetchone()[0] >= 2:
+        return
+    with meta_batch():
+        cols = {r["name"] for r in conn.execute("PRAGMA table_info(tokens)")}
+        for col in ("vault", "kek"):
+            if col not in cols:
+                conn.execute(f"ALTER TABLE tokens ADD COLUMN {col} TEXT")
+        conn.execute("PRAGMA user_version = 2")
+
+def _insert_item(conn, token_str: str, item: dict) -> int:
+    info = {k: v for k, v in item.items() if k not in ("id", "vault", "orig")}
+    cur = conn.execute(
+        "INSERT INTO items(token, orig, vault, info) VALUES (?, ?, ?, ?)",
+        (token_str, item["orig"], item["vault"], json.dumps(info)),
+    )
+    return cur.lastrowid
+
+def _row_to_item(row) -> dict:
+    item = json.loads(row["info"])
+    item.update(id=row["id"], vault=row["vault"], orig=row["orig"])
+    return item
+
+def get_token(token_str: str):
+    """Return {"salt": <b64>, "vault": <id or None>, "kek": <dict or None>} for a registered token, or None."""
+    row = _db().execute("SELECT salt, vault, kek FROM tokens WHERE token = ?", (token_str,)).fetchone()
+    if row is None:
+        return None
+    return {"salt": row["salt"], "vault": row["vault"], "kek": json.loads(row["kek"]) if row["kek"] else None}
+
+def add_token(token_str: str, salt_b64: str = None, vault: str = None, kek: dict = None):
+    salt_b64 = salt_b64 or base64.b64encode(secrets.token_bytes(16)).decode()
+    _db().execute(
+        "INSERT OR REPLACE INTO tokens(token, salt, vault, kek) VALUES (?, ?, ?, ?)",
+        (token_str, salt_b64, vault, json.dumps(kek) if kek else None),
+    )
+
+def set_token_kek(token_str: str, kek: dict):
+    _db().execute("UPDATE tokens SET kek = ? WHERE token = ?", (json.dumps(kek), token_str))
+
+def remove_token(token_str: str):
+    _db().execute("DELETE FROM tokens WHERE token = ?", (token_str,))
+
+def vault_of(token_str: str) -> str:
+    """Vault id whose items token_str unlocks: itself, unless it is a backup or replacement token."""
+    row = _db().execute("SELECT vault FROM tokens WHERE token = ?", (token_str,)).fetchone()
+    return row["vault"] if row and row["vault"] else token_str
+
+def vault_tokens(vault: str) -> list:
+    """Every registered token that unlocks vault."""
+    rows = _db().execute("SELECT token FROM tokens WHERE token = ? OR vault = ?", (vault, vault))
+    return [r["token"] for r in rows]
+
+def list_items(token_str: str, subpath: str = None) -> list:
+    """
+    Items of token_str, or only those at or below subpath (an index range scan,
+    so the cost follows the number of matches, not the size of the vault).
+    """
+    if subpath is None:
+        rows = _db().execute("SELECT * FROM items WHERE token = ? ORDER BY id", (token_str,))
+        return [_row_to_item(r) for r in rows]
+    base = os.path.abspath(subpath).rstrip(os.sep)
+    # every path below base sorts between base + sep and base + (sep + 1)
+    rows = _db().execute(
+        "SELECT * FROM items WHERE token = ? AND (orig = ? OR (orig >= ? AND orig < ?)) ORDER BY orig",
+        (token_str, base, base + os.sep, base + chr(ord(os.sep) + 1)),
+    )
+    return [_row_to_item(r) for r in rows]
+
+def find_item(token_str: str, orig: str):
+    """The live entry for an original path, or None."""
+    row = _db().execute("SELECT * FROM items WHERE token = ? AND orig = ?", (token_str, orig)).fetchone()
+    return _row_to_item(row) if row else None
+
+def add_item(token_str: str, item: dict) -> int:
+    return _insert_item(_db(), token_str, item)
+
+def update_item(item: dict):
+    info = {k: v for k, v in item.items() if k not in ("id", "vault", "orig")}
+    _db().execute(
+        "UPDATE items SET orig = ?, vault = ?, info = ? WHERE id = ?",
+        (item["orig"], item["vault"], json.dumps(info), item["id"]),
+    )
+
+def set_item_fp(item_id: int, fp: dict = None):
+    """Set (or with None clear) only an item's reveal fingerprint, leaving its storage location alone."""
+    if fp is None:
+        _db().execute("UPDATE items SET info = json_remove(info, '$.fp') WHERE id = ?", (item_id,))
+    else:
+        _db().execute("UPDATE items SET info = json_set(info, '$.fp', json(?)) WHERE id = ?",
+                      (json.dumps(fp), item_id))
+
+def ref_chunks(token_str: str, chunk_ids, delta: int):
+    """Add delta to the refcount of each chunk id (once per occurrence)."""
+    _db().executemany(
+        "INSERT INTO chunks(token, id, refs) VALUES (?, ?, ?) "
+        "ON CONFLICT(token, id) DO UPDATE SET refs = refs + excluded.refs",
+        [(token_str, cid, delta) for cid in chunk_ids],
+    )
+
+def pop_dead_chunks(token_str: str) -> list:
+    """Forget chunks no item references any more and return their ids."""
+    conn = _db()
+    ids = [r["id"] for r in conn.execute("SELECT id FROM chunks WHERE token = ? AND refs <= 0", (token_str,))]
+    conn.execute("DELETE FROM chunks WHERE token = ? AND refs <= 0", (token_str,))
+    return ids
+
+# --- batch journal ---
+# assign and hide keep one journal row per file while they work on it:
+#   read      storage planned (vault name, original size/mtime) before anything is written
+#   sealed    encrypted; "sealed" holds the new item fields
+#   committed item row written in the same transaction; the original may be mid-wipe
+# and the row is deleted once the original is gone. recover_journal() settles
+# the rows of a process that died: sealed work is committed without encrypting
+# again, committed originals are wiped, and planned-but-unsealed storage is removed.
+_journal_owner_id = None
+
+def _journal_owner() -> str:
+    global _journal_owner_id
+    if _journal_owner_id is None:
+        import psutil
+        _journal_owner_id = f"{os.getpid()}:{psutil.Process().create_time()}"
+    return _journal_owner_id
+
+def _owner_alive(owner: str) -> bool:
+    import psutil
+    pid, started = owner.split(":", 1)
+    try:
+        return str(psutil.Process(int(pid)).create_time()) == started
+    except (psutil.NoSuchProcess, ValueError):
+        return False
+
+def journal_begin(op: str, token_str: str, path: Path, vault_name: str = "", item_id: int = None,
+                  state: str = "read") -> int:
+    st = path.stat()
+    plan = {"vault": vault_name, "size": st.st_size, "mtime_ns": st.st_mtime_ns}
+    if item_id is not None:
+        plan["item"] = item_id
+    cur = _db().execute(
+        "INSERT INTO journal(op, token, path, state, owner, plan) VALUES (?, ?, ?, ?, ?, ?)",
+        (op, token_str, str(path), state, _journal_owner(), json.dumps(plan)),
+    )
+    return cur.lastrowid
+
+def journal_sealed(jid: int, sealed: dict):
+    _db().execute("UPDATE journal SET state = 'sealed', sealed = ? WHERE id = ?", (json.dumps(sealed), jid))
+
+def journal_committed(jid: int, drop_vault: str = None):
+    """Mark a row committed (call inside the meta_batch that writes its item)."""
+    _db().execute(
+        "UPDATE journal SET state = 'committed', plan = json_set(plan, '$.drop', ?) WHERE id = ?",
+        (drop_vault or "", jid),
+    )
+
+def journal_done(jids):
+    _db().executemany("DELETE FROM journal WHERE id = ?", [(jid,) for jid in jids])
+
+def _journal_rollback(token_str: str, jid: int, plan: dict, sealed: dict = None):
+    """Drop a row that never got committed, with whatever storage it had written."""
+    if plan.get("vault"):
+        blob = VAULT_DIR / plan["vault"]
+        blob.unlink(missing_ok=True)
+        for tmp in VAULT_DIR.glob(f".{blob.name}.*.tmp"):
+            tmp.unlink(missing_ok=True)
+    if sealed and sealed.get("chunks"):
+        # chunks some committed item already references stay
+        conn = _db()
+        delete_chunks([cid for cid in set(sealed["chunks"]) if conn.execute(
+            "SELECT 1 FROM chunks WHERE token = ? AND id = ?", (token_str, cid)).fetchone() is None])
+    # sealed segment slots are dead space; compaction reclaims them
+    journal_done([jid])
+
+def _sealed_present(sealed: dict) -> bool:
+    if "seg" in sealed:
+        return (SEGMENTS_DIR / sealed["seg"]).exists()
+    if "chunks" in sealed:
+        return all(_chunk_path(cid).exists() for cid in sealed["chunks"])
+    return (VAULT_DIR / sealed["vault"]).exists()
+
+def _wipe_done(path: Path, wiped: bool) -> bool:
+    return wiped or not path.exists()
+
+def recover_journal(token_str: str) -> int:
+    """
+    Settle journal rows of token_str left by processes that are no longer running.
+    Returns how many files were affected.
+    """
+    rows = [r for r in _db().execute("SELECT * FROM journal WHERE token = ? ORDER BY id", (token_str,))
+            if r["owner"] != _journal_owner() and not _owner_alive(r["owner"])]
+    wipe = []
+    for r in rows:
+        plan = json.loads(r["plan"])
+        sealed = json.loads(r["sealed"]) if r["sealed"] else None
+        path = Path(r["path"])
+        if r["state"] == "sealed":
+            st = path.stat() if path.is_file() else None
+            if not (st is not None and (st.st_size, st.st_mtime_ns) == (plan["size"], plan["mtime_ns"])
+                    and _sealed_present(sealed)
+                    and _journal_commit_sealed(r["op"], token_str, r["id"], path, plan, sealed)):
+                _journal_rollback(token_str, r["id"], plan, sealed)
+                continue
+        elif r["state"] != "committed":
+            _journal_rollback(token_str, r["id"], plan, sealed)
+            continue
+        wipe.append((r["id"], path, plan))
+    done = []
+    for jid, path, plan in wipe:
+        if plan.get("drop"):
+            (VAULT_DIR / plan["drop"]).unlink(missing_ok=True)
+        st = path.stat() if path.is_file() else None
+        if st is not None and (st.st_size, st.st_mtime_ns) != (plan["size"], plan["mtime_ns"]):
+            # edited after it was sealed: the vault has the older content, so keep the
+            # file; its item has no fingerprint, so the next hide re-seals it
+            print("Changed since it was sealed, left in place (hide again to re-seal):", path)
+            done.append(jid)
+            continue
+        if _wipe_done(path, secure_delete_file(path)):
+            done.append(jid)
+    with meta_batch():
+        journal_done(done)
+        dead = pop_dead_chunks(token_str)
+    delete_chunks(dead)
+    if rows:
+        print(f"Recovered {len(rows)} files from an interrupted batch for token", token_str)
+    return len(rows)
+
+def _journal_commit_sealed(op: str, token_str: str, jid: int, path: Path, plan: dict, sealed: dict) -> bool:
+    """
+    Commit a sealed row found by recover_journal(); the replaced blob (if any) is
+    left in plan["drop"]. False if the item a hide row belonged to is gone.
+    """
+    with meta_batch():
+        if op == "assign":
+            old = _save_vault_item(token_str, str(path), sealed)
+            plan["drop"] = old["vault"] if old else ""
+        else:
+            row = _db().execute("SELECT * FROM items WHERE id = ?", (plan["item"],)).fetchone()
+            if row is None:
+                return False
+            item = _row_to_item(row)
+            item.pop("fp", None)
+            old_chunks, plan["drop"] = _apply_sealed(item, sealed)
+            update_item(item)
+            if old_chunks is not None:
+                ref_chunks(token_str, sealed["chunks"], 1)
+                ref_chunks(token_str, old_chunks, -1)
+        journal_committed(jid, plan["drop"])
+    return True
+
+# --- KDFs ---
+# Parameters travel as dicts ({"name": ..., cost fields}) and are stored per token
+# next to the wrapped key, so each token can be unlocked with whatever it was
+# wrapped with and rewrapped when the local policy (kdf_policy()) changes.
+# cost knob per KDF: (field, start, floor, cap); unlock time grows linearly with it
+_KDF_COST = {
+    "pbkdf2": ("iterations", 10_000, 50_000, 10_000_000),
+    "scrypt": ("n", 2 ** 12, 2 ** 14, 2 ** 18),
+    "argon2id": ("iterations", 1, 1, 64),
+}
+
+def _kdf(params: dict, salt: bytes):
+    name = params["name"]
+    if name == "pbkdf2":
+        from cryptography.hazmat.primitives import hashes
+        from cryptography.hazmat.primitives.kdf.pbkdf2 import PBKDF2HMAC
+        return PBKDF2HMAC(algorithm=hashes.SHA256(), length=32, salt=salt, iterations=params["iterations"])
+    if name == "scrypt":
+        from cryptography.hazmat.primitives.kdf.scrypt import Scrypt
+        return Scrypt(salt=salt, length=32, n=params["n"], r=params.get("r", 8), p=params.get("p", 1))
+    if name == "argon2id":
+        try:
+            from cryptography.hazmat.primitives.kdf.argon2 import Argon2id
+        except ImportError:
+            raise ValueError("argon2id needs cryptography >= 44")
+        return Argon2id(salt=salt, length=32, iterations=params["iterations"],
+                        lanes=params.get("lanes", 4), memory_cost=params.get("memory_kib", 65536))
+    raise ValueError(f"unknown KDF {name!r}")
 
-def read_meta():
+def derive_key(password: str, token_bytes: bytes, salt: bytes, params: dict = None) -> bytes:
+    return _kdf(params or LEGACY_KDF, salt).derive(password.encode() + token_bytes)
+
+def _kdf_name() -> str:
+    if KDF_NAME:
+        return KDF_NAME
+    try:
+        from cryptography.hazmat.primitives.kdf.argon2 import Argon2id  # noqa: F401
+        return "argon2id"
+    except ImportError:  # cryptography < 44
+        return "scrypt"
+
+def _kdf_params(name: str, cost: int, memory_kib: int = 65536) -> dict:
+    field = _KDF_COST[name][0]
+    params = {"name": name, field: cost}
+    if name == "scrypt":
+        params.update(r=8, p=1)
+    elif name == "argon2id":
+        params.update(lanes=4, memory_kib=memory_kib)
+    return params
+
+def _time_kdf(params: dict, salt: bytes) -> float:
+    t = time.perf_counter()
+    _kdf(params, salt).derive(b"calibration")
+    return (time.perf_counter() - t) * 1000
+
+def calibrate_kdf(name: str = None, target_ms: float = KDF_TARGET_MS) -> dict:
+    """
+    Pick cost parameters for name so one derivation takes about target_ms here.
+    Measures at growing cost until a run takes a quarter of the target, then
+    scales linearly; never goes below the KDF's floor.
+    """
+    name = name or _kdf_name()
+    field, cost, floor, cap = _KDF_COST[name]
+    salt = secrets.token_bytes(16)
+    memory_kib = 65536
+    if name == "argon2id":
+        # one pass over 64 MiB is already too slow: trade memory down to the OWASP minimum
+        while memory_kib > 19456 and _time_kdf(_kdf_params(name, 1, memory_kib), salt) > target_ms:
+            memory_kib = max(19456, memory_kib // 2)
+    while True:
+        ms = _time_kdf(_kdf_params(name, cost, memory_kib), salt)
+        if ms >= target_ms / 4 or cost >= cap:
+            break
+        cost *= 2
+    want = cost * target_ms / max(ms, 0.001)
+    if name == "scrypt":
+        want = 2 ** round(math.log2(max(want, 1)))  # n must be a power of two
+    return _kdf_params(name, int(min(cap, max(floor, want))), memory_kib)
+
+def kdf_policy(recalibrate: bool = False) -> dict:
+    """KDF parameters new wraps use on this machine (calibrated once, then read from KDF_CALIBRATION)."""
+    try:
+        saved = json.loads(KDF_CALIBRATION.read_text())
+    except (OSError, ValueError):
+        saved = None
+    if (not recalibrate and saved and saved["params"]["name"] == _kdf_name()
+            and saved["target_ms"] == KDF_TARGET_MS):
+        return saved["params"]
+    params = calibrate_kdf()
     ensure_dirs()
-    return json.loads(META_FILE.read_text())
+    tmp = _tmp_sibling(KDF_CALIBRATION)
+    tmp.write_text(json.dumps({"params": params, "target_ms": KDF_TARGET_MS, "calibrated": time.time()}))
+    os.replace(tmp, KDF_CALIBRATION)
+    return params
+
+# --- key cache ---
+# {(token, salt, kdf params): [key bytearray, password tag, expires_at]}
+# The password itself is never stored; a keyed tag of it tells a repeat of the
+# same password apart from a different one so a wrong password still re-derives.
+_key_cache = {}
+_key_cache_lock = threading.Lock()
+_pw_tag_secret = secrets.token_bytes(32)
+_key_sweeper = None  # Timer due at the earliest expiry, so idle processes drop keys on time
+
+def _zeroize(buf: bytearray):
+    buf[:] = bytes(len(buf))
 
-def write_meta(m):
-    META_FILE.write_text(json.dumps(m, indent=2))
+def _purge_expired_keys(now: float):
+    for k in [k for k, ent in _key_cache.items() if ent[2] <= now]:
+        _zeroize(_key_cache.pop(k)[0])
 
-def derive_key(password: str, token_bytes: bytes, salt: bytes) -> bytes:
-    kdf = PBKDF2HMAC(algorithm=hashes.SHA256(), length=32, salt=salt, iterations=200_000)
-    return kdf.derive(password.encode() + token_bytes)
+def _schedule_key_sweep():
+    # called with _key_cache_lock held
+    global _key_sweeper
+    if _key_sweeper is not None or not _key_cache:
+        return
+    delay = max(0.0, min(ent[2] for ent in _key_cache.values()) - time.monotonic())
+    _key_sweeper = threading.Timer(delay, _sweep_keys)
+    _key_sweeper.daemon = True
+    _key_sweeper.start()
+
+def _sweep_keys():
+    global _key_sweeper
+    with _key_cache_lock:
+        _key_sweeper = None
+        _purge_expired_keys(time.monotonic())
+        _schedule_key_sweep()  # entries whose TTL was extended meanwhile
+
+def get_key(password: str, token_str: str, salt: bytes, params: dict = None) -> bytes:
+    """derive_key() with a per-session cache keyed by (token, salt, KDF params)."""
+    now = time.monotonic()
+    pw_tag = hmac.new(_pw_tag_secret, password.encode(), hashlib.sha256).digest()
+    ck = (token_str, salt, json.dumps(params or LEGACY_KDF, sort_keys=True))
+    with _key_cache_lock:
+        _purge_expired_keys(now)
+        ent = _key_cache.get(ck)
+        if ent and hmac.compare_digest(ent[1], pw_tag):
+            ent[2] = now + KEY_CACHE_TTL
+            return bytes(ent[0])
+    with metrics.span("kdf"):
+        key = derive_key(password, token_str.encode(), salt, params)
+    with _key_cache_lock:
+        old = _key_cache.pop(ck, None)
+        if old:
+            _zeroize(old[0])
+        _key_cache[ck] = [bytearray(key), pw_tag, now + KEY_CACHE_TTL]
+        _schedule_key_sweep()
+    return key
+
+def clear_key_cache(token_str: str = None):
+    """Zeroize and drop cached keys (all, or only those of one token, e.g. on USB removal)."""
+    with _key_cache_lock:
+        for k in [k for k in _key_cache if token_str is None or k[0] == token_str]:
+            _zeroize(_key_cache.pop(k)[0])
+
+# --- envelope keys ---
+# Each vault has a random 256-bit data key (DEK) that encrypts its items. Every
+# token that unlocks it stores the DEK wrapped (AES-GCM) under its own KEK,
+# derived from password + token with a per-wrap salt. Password changes, backup
+# tokens and token replacement only rewrap the DEK; vault blobs are never touched.
+# Tokens from before envelopes derived their items' key directly from
+# (password, token, salt); on first unlock that key is kept as the DEK.
+def _aesgcm(key: bytes):
+    from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+    return AESGCM(key)
+
+def wrap_key(kek: bytes, dek: bytes, token_str: str) -> str:
+    nonce = secrets.token_bytes(12)
+    return base64.b64encode(nonce + _aesgcm(kek).encrypt(nonce, dek, token_str.encode())).decode()
+
+def unwrap_key(kek: bytes, wrapped: str, token_str: str) -> bytes:
+    """Raises InvalidTag if kek (i.e. the password) is wrong."""
+    blob = base64.b64decode(wrapped)
+    return _aesgcm(kek).decrypt(blob[:12], blob[12:], token_str.encode())
+
+def _new_kek(password: str, token_str: str, dek: bytes, params: dict = None) -> dict:
+    params = params or kdf_policy()
+    salt = secrets.token_bytes(16)
+    kek = get_key(password, token_str, salt, params)
+    return {"salt": base64.b64encode(salt).decode(), "kdf": params, "wrapped": wrap_key(kek, dek, token_str)}
 
 def encrypt_blob(key: bytes, plaintext: bytes) -> bytes:
-    aes = AESGCM(key)
+    aes = _aesgcm(key)
     nonce = secrets.token_bytes(12)
-    ct = aes.encrypt(nonce, plaintext, None)
+    with metrics.span("encrypt"):
+        ct = aes.encrypt(nonce, plaintext, None)
+    metrics.add("bytes.encrypted", len(plaintext))
     return nonce + ct
 
 def decrypt_blob(key: bytes, blob: bytes) -> bytes:
-    aes = AESGCM(key)
-    nonce = blob[:12]
-    ct = blob[12:]
-    return aes.decrypt(nonce, ct, None)
+    aes = _aesgcm(key)
+    view = memoryview(blob)
+    with metrics.span("decrypt"):
+        plain = aes.decrypt(view[:12], view[12:], None)
+    metrics.add("bytes.decrypted", len(plain))
+    return plain
+
+# --- streaming vault format ---
+# header:  magic(4) | chunk_size(4) | nonce prefix(8)
+# records: length(4) | last(1) | AES-GCM(chunk)
+# Each chunk nonce is prefix + counter(4). The header, counter and last flag are
+# authenticated as associated data, so reordered, dropped or truncated chunks fail.
+def _chunk_aad(header: bytes, counter: int, last: bool) -> bytes:
+    return header + struct.pack(">IB", counter, last)
+
+class _ViewReader:
+    """
+    read() over a mapped file that returns zero-copy memoryview slices.
+    Pages well behind the read position are dropped from the mapping
+    (MADV_DONTNEED re-faults them from the file if touched again), so resident
+    memory stays at a few chunks however large the file is.
+    """
+    def __init__(self, mm: mmap.mmap, view: memoryview, pos: int = 0):
+        self.mm = mm
+        self.view = view
+        self.pos = pos
+        self.dropped = pos - pos % mmap.PAGESIZE
+
+    def read(self, n: int) -> memoryview:
+        behind = self.pos - 2 * n
+        if hasattr(mmap, "MADV_DONTNEED") and behind - self.dropped >= n:
+            end = behind - behind % mmap.PAGESIZE
+            self.mm.madvise(mmap.MADV_DONTNEED, self.dropped, end - self.dropped)
+            self.dropped = end
+        chunk = self.view[self.pos:self.pos + n]
+        self.pos += len(chunk)
+        return chunk
+
+@contextlib.contextmanager
+def _mapped(fin):
+    """
+    Yield a zero-copy reader over the rest of fin's file when it is at least
+    MMAP_MIN bytes, else fin itself. A mapped file truncated by another process
+    mid-read raises SIGBUS; SAFEKEY_MMAP=0 turns mapping off.
+    """
+    try:
+        fd = fin.fileno()
+        size = os.fstat(fd).st_size
+        pos = fin.tell()
+    except (AttributeError, OSError, io.UnsupportedOperation):
+        size = pos = 0
+    if not MMAP_READS or size - pos < MMAP_MIN:
+        yield fin
+        return
+    mm = mmap.mmap(fd, 0, access=mmap.ACCESS_READ)
+    if hasattr(mmap, "MADV_SEQUENTIAL"):
+        mm.madvise(mmap.MADV_SEQUENTIAL)
+    view = memoryview(mm)
+    try:
+        yield _ViewReader(mm, view, pos)
+    finally:
+        view.release()
+        try:
+            mm.close()
+        except BufferError:
+            pass  # slices still referenced (e.g. by a traceback); unmapped on GC
+
+def encrypt_stream(key: bytes, fin, fout, chunk_size: int = STREAM_CHUNK_SIZE, codec: str = None):
+    """
+    With a codec, every chunk plaintext is one flag byte (1 = compressed, 0 = raw,
+    used when compression doesn't shrink it) followed by the data.
+    Returns the number of plaintext bytes read from fin.
+    """
+    aes = _aesgcm(key)
+    into = hasattr(aes, "encrypt_into")  # cryptography >= 46 encrypts into caller-owned buffers
+    compress = _codec(codec)[0] if codec else None
+    prefix = secrets.token_bytes(8)
+    header = STREAM_MAGIC + struct.pack(">I", chunk_size) + prefix
+    out = memoryview(bytearray(chunk_size + 17))  # flag byte + chunk + tag
+    fout.write(header)
+    counter = 0
+    clock = time.perf_counter
+    t_read = t_comp = t_enc = t_write = 0.0
+    nbytes = 0
+    try:
+        with _mapped(fin) as src:
+            t = clock()
+            chunk = src.read(chunk_size)
+            t_read += clock() - t
+            while True:
+                t = clock()
+                nxt = src.read(chunk_size) if len(chunk) == chunk_size else b""
+                t1 = clock()
+                t_read += t1 - t
+                nbytes += len(chunk)
+                last = not nxt
+                if compress:
+                    packed = compress(chunk)
+                    chunk = b"\x01" + packed if len(packed) < len(chunk) else b"\x00" + chunk
+                t2 = clock()
+                nonce = prefix + struct.pack(">I", counter)
+                aad = _chunk_aad(header, counter, last)
+                if into:
+                    ct = out[:len(chunk) + 16]
+                    aes.encrypt_into(nonce, chunk, aad, ct)
+                else:
+                    ct = aes.encrypt(nonce, chunk, aad)
+                t3 = clock()
+                fout.write(struct.pack(">IB", len(ct), last))
+                fout.write(ct)
+                t_comp += t2 - t1
+                t_enc += t3 - t2
+                t_write += clock() - t3
+                if last:
+                    return nbytes
+                chunk = nxt
+                counter += 1
+    finally:
+        metrics.observe("read", t_read)
+        if compress:
+            metrics.observe("compress", t_comp)
+        metrics.observe("encrypt", t_enc)
+        metrics.observe("write", t_write)
+        metrics.add("bytes.encrypted", nbytes)
+
+def decrypt_stream(key: bytes, fin, fout, codec: str = None):
+    aes = _aesgcm(key)
+    into = hasattr(aes, "decrypt_into")
+    decompress = _codec(codec)[1] if codec else None
+    clock = time.perf_counter
+    t_read = t_dec = t_write = 0.0
+    nbytes = 0
+    try:
+        with _mapped(fin) as src:
+            header = bytes(src.read(16))
+            if len(header) != 16 or header[:4] != STREAM_MAGIC:
+                raise ValueError("Not a stream vault blob")
+            chunk_size = struct.unpack(">I", header[4:8])[0]
+            prefix = header[8:]
+            out = memoryview(bytearray(chunk_size + 1))
+            counter = 0
+            while True:
+                t = clock()
+                rec = src.read(5)
+                if len(rec) != 5:
+                    raise ValueError("Truncated vault blob")
+                length, last = struct.unpack(">IB", rec)
+                if not 16 <= length <= chunk_size + 17:
+                    raise ValueError("Corrupt vault blob record")
+                ct = src.read(length)
+                if len(ct) != length:
+                    raise ValueError("Truncated vault blob")
+                t1 = clock()
+                nonce = prefix + struct.pack(">I", counter)
+                aad = _chunk_aad(header, counter, bool(last))
+                if into:
+                    chunk = out[:length - 16]
+                    aes.decrypt_into(nonce, ct, aad, chunk)
+                else:
+                    chunk = aes.decrypt(nonce, ct, aad)
+                if decompress:
+                    chunk = decompress(chunk[1:]) if chunk[:1] == b"\x01" else chunk[1:]
+                t2 = clock()
+                fout.write(chunk)
+                t_read += t1 - t
+                t_dec += t2 - t1
+                t_write += clock() - t2
+                nbytes += len(chunk)
+                if last:
+                    return
+                counter += 1
+    finally:
+        metrics.observe("read", t_read)
+        metrics.observe("decrypt", t_dec)
+        metrics.observe("write", t_write)
+        metrics.add("bytes.decrypted", nbytes)
+
+def stream_records(fin, end: int = None):
+    """
+    Index a stream blob starting at fin's position without decrypting it.
+    Returns (header, [(offset, length, last), ...]) with absolute file offsets of
+    each record's ciphertext. Plaintext chunk i starts at i * chunk_size.
+    """
+    base = fin.tell()
+    header = fin.read(16)
+    if len(header) != 16 or header[:4] != STREAM_MAGIC:
+        raise ValueError("Not a stream vault blob")
+    records = []
+    pos = base + 16
+    while True:
+        rec = fin.read(5)
+        if len(rec) != 5:
+            raise ValueError("Truncated vault blob")
+        length, last = struct.unpack(">IB", rec)
+        records.append((pos + 5, length, bool(last)))
+        pos += 5 + length
+        if last:
+            return header, records
+        if end is not None and pos >= end:
+            raise ValueError("Truncated vault blob")
+        fin.seek(pos)
+
+def decrypt_stream_record(key: bytes, header: bytes, counter: int, last: bool, ct, codec: str = None) -> bytes:
+    """Decrypt one record of a stream blob (see stream_records) on its own."""
+    nonce = header[8:] + struct.pack(">I", counter)
+    chunk = _aesgcm(key).decrypt(nonce, ct, _chunk_aad(header, counter, last))
+    if codec:
+        chunk = _codec(codec)[1](chunk[1:]) if chunk[:1] == b"\x01" else chunk[1:]
+    return chunk
+
+# --- compression ---
+def _codec(name: str):
+    """Return (compress, decompress) for a codec name; ValueError if it isn't usable here."""
+    if name == "zlib":
+        return (lambda b: zlib.compress(b, 1)), zlib.decompress
+    if name == "zstd":
+        try:
+            import zstandard
+        except ImportError:
+            raise ValueError("zstd compression needs the 'zstandard' package")
+        return (lambda b: zstandard.ZstdCompressor(level=3).compress(b)), (lambda b: zstandard.ZstdDecompressor().decompress(b))
+    if name == "lz4":
+        try:
+            import lz4.frame
+        except ImportError:
+            raise ValueError("lz4 compression needs the 'lz4' package")
+        return lz4.frame.compress, lz4.frame.decompress
+    raise ValueError(f"Unknown compression codec: {name}")
+
+def choose_codec(src: Path, codec: str):
+    """
+    Return codec, or None if src looks already compressed: by suffix, or when a
+    fast zlib pass over its first 64 KiB saves less than 10%.
+    """
+    if not codec or src.suffix.lower() in INCOMPRESSIBLE_SUFFIXES:
+        return None
+    with open(src, "rb") as f:
+        sample = f.read(64 * 1024)
+    if len(sample) < 512 or len(zlib.compress(sample, 1)) > 0.9 * len(sample):
+        return None
+    return codec
+
+def _tmp_sibling(path: Path) -> Path:
+    return path.with_name(f".{path.name}.{secrets.token_hex(4)}.tmp")
+
+def seal_file(key: bytes, src: Path, dst: Path, codec: str = None):
+    """
+    Encrypt src into dst in the stream format without loading it into memory.
+    codec (default COMPRESS) is subject to choose_codec(); returns (codec used, plaintext size).
+    """
+    codec = choose_codec(src, COMPRESS if codec is None else codec)
+    tmp = _tmp_sibling(dst)
+    try:
+        with open(src, "rb") as fin, open(tmp, "wb") as fout:
+            size = encrypt_stream(key, fin, fout, codec=codec)
+        os.replace(tmp, dst)
+    except BaseException:
+        tmp.unlink(missing_ok=True)
+        raise
+    return codec, size
+
+class _HashingWriter:
+    """File wrapper that hashes everything written through it."""
+    def __init__(self, f):
+        self.f = f
+        self.hash = _content_hash()
+
+    def write(self, data):
+        self.hash.update(data)
+        return self.f.write(data)
+
+def _content_hash():
+    return hashlib.blake2b(digest_size=16)
+
+def unseal_file(key: bytes, item: dict, dst: Path) -> str:
+    """
+    Decrypt the vault blob of a meta item into dst and return the plaintext hash.
+    Plaintext goes to a temp file next to dst and is only renamed over dst once
+    every chunk authenticated; a failed decrypt never leaves a partial file.
+    """
+    src = VAULT_DIR / item["vault"]
+    tmp = _tmp_sibling(dst)
+    try:
+        with open(tmp, "wb") as f:
+            fout = _HashingWriter(f)
+            if item.get("fmt") == DEDUP_FORMAT:
+                for cid in item["chunks"]:
+                    fout.write(decrypt_blob(key, _chunk_path(cid).read_bytes()))
+            elif "seg" in item:
+                with _segment_file(item) as fin:
+                    fin.seek(item["off"])
+                    decrypt_stream(key, fin, fout, item.get("codec"))
+            elif item.get("fmt") == STREAM_FORMAT:
+                with open(src, "rb") as fin:
+                    decrypt_stream(key, fin, fout, item.get("codec"))
+            else:
+                fout.write(decrypt_blob(key, src.read_bytes()))
+        os.replace(tmp, dst)
+    except BaseException:
+        secure_delete_file(tmp)
+        raise
+    return fout.hash.hexdigest()
+
+# --- packed segments ---
+# Small files are sealed in memory and appended to the process's active segment
+# file; the item records {"seg", "off", "len"} instead of a vault file name.
+# The active segment is flock'ed so compaction in another process leaves it alone.
+# A segment keeps its file open and flock'ed, even after rolling over, while any
+# slot appended to it is not committed yet (segments_settled() releases them).
+_segment_lock = threading.Lock()
+_active_segment = None  # (name, file object)
+_segment_pending = {}   # segment name -> appended slots not yet committed
+_retired_segments = {}  # segment name -> file object of a rolled-over segment with pending slots
+
+def _roll_segment():
+    global _active_segment
+    if _active_segment is not None:
+        name, f = _active_segment
+        if _segment_pending.get(name):
+            _retired_segments[name] = f
+        else:
+            f.close()
+    name = secrets.token_hex(8)
+    f = open(SEGMENTS_DIR / name, "xb")
+    if fcntl is not None:
+        fcntl.flock(f.fileno(), fcntl.LOCK_EX)
+    _active_segment = (name, f)
+
+def segment_append(blob: bytes) -> dict:
+    """Append a sealed blob to the active segment and return its location."""
+    with _segment_lock:
+        if _active_segment is None or _active_segment[1].tell() + len(blob) > SEGMENT_MAX:
+            _roll_segment()
+        name, f = _active_segment
+        off = f.tell()
+        f.write(blob)
+        f.flush()
+        _segment_pending[name] = _segment_pending.get(name, 0) + 1
+    return {"seg": name, "off": off, "len": len(blob)}
+
+def segments_settled(locs):
+    """
+    Call once the items holding these slots (dicts from segment_append; others are
+    ignored) are committed or abandoned, so their segments may be compacted again.
+    """
+    with _segment_lock:
+        for loc in locs:
+            if not loc or "seg" not in loc:
+                continue
+            name = loc["seg"]
+            left = _segment_pending.get(name, 0) - 1
+            if left > 0:
+                _segment_pending[name] = left
+                continue
+            _segment_pending.pop(name, None)
+            f = _retired_segments.pop(name, None)
+            if f is not None:
+                f.close()
+
+def _follow_segment(item: dict) -> bool:
+    """If compaction moved item's slot, point item at the new one; False if it didn't."""
+    if "id" not in item:
+        return False
+    row = _db().execute("SELECT info FROM items WHERE id = ?", (item["id"],)).fetchone()
+    loc = json.loads(row["info"]) if row else {}
+    if loc.get("seg") in (None, item["seg"]):
+        return False
+    item.update(seg=loc["seg"], off=loc["off"], len=loc["len"])
+    return True
+
+def _segment_file(item: dict):
+    """Open item's segment for reading, following its slot if compaction moved it meanwhile."""
+    while True:
+        try:
+            return open(SEGMENTS_DIR / item["seg"], "rb")
+        except FileNotFoundError:
+            if not _follow_segment(item):
+                raise
+
+def seal_small_file(key: bytes, src: Path) -> dict:
+    """Seal src in memory into the active segment; returns the new item fields."""
+    codec = choose_codec(src, COMPRESS)
+    buf = io.BytesIO()
+    with open(src, "rb") as fin:
+        size = encrypt_stream(key, fin, buf, codec=codec)
+    item = {"vault": "", "fmt": STREAM_FORMAT, "size": size}
+    item.update(segment_append(buf.getvalue()))
+    if codec:
+        item["codec"] = codec
+    return item
+
+def _segment_rows(conn, name: str) -> dict:
+    rows = conn.execute("SELECT id, info FROM items WHERE json_extract(info, '$.seg') = ?", (name,))
+    return {r["id"]: json.loads(r["info"]) for r in rows}
+
+def compact_segments(threshold: float = COMPACT_THRESHOLD, limit=None) -> int:
+    """
+    Copy the live blobs of mostly-dead segments into the active segment and drop
+    the old files. Blobs are moved still encrypted, so no key is needed.
+    limit (a _RateLimit) throttles the copying.
+    A segment is only touched under an exclusive flock (so never while a process
+    still has uncommitted slots in it), and its live rows are re-read in the
+    transaction that repoints them. Returns the number of bytes reclaimed.
+    """
+    ensure_dirs()
+    conn = _db()
+    used = {}
+    for row in conn.execute("SELECT info FROM items WHERE json_extract(info, '$.seg') IS NOT NULL"):
+        loc = json.loads(row["info"])
+        used[loc["seg"]] = used.get(loc["seg"], 0) + loc["len"]
+    reclaimed = 0
+    for path in list(SEGMENTS_DIR.iterdir()):
+        with _segment_lock:
+            if path.name in _segment_pending or (_active_segment is not None and _active_segment[0] == path.name):
+                continue
+        try:
+            f = open(path, "rb")
+        except FileNotFoundError:
+            continue  # another compaction got here first
+        with f:
+            if fcntl is not None:
+                try:
+                    fcntl.flock(f.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+                except OSError:
+                    continue  # being written or compacted elsewhere
+            st = os.fstat(f.fileno())
+            if fcntl is None and time.time() - st.st_mtime < GC_GRACE:
+                continue
+            if st.st_size and used.get(path.name, 0) / st.st_size >= threshold:
+                continue
+            if st.st_nlink == 0:
+                continue  # unlinked by a compaction that finished before we locked it
+            moved = {}
+            for item_id, loc in _segment_rows(conn, path.name).items():
+                if limit is not None:
+                    limit.take(loc["len"])
+                f.seek(loc["off"])
+                moved[item_id] = (loc, segment_append(f.read(loc["len"])))
+            keep = False
+            try:
+                with meta_batch() as conn:
+                    for item_id, loc in _segment_rows(conn, path.name).items():
+                        old, new = moved.get(item_id, (None, None))
+                        if old is None or (old["off"], old["len"]) != (loc["off"], loc["len"]):
+                            keep = True  # committed after the copy (only possible without flock)
+                            continue
+                        conn.execute("UPDATE items SET info = json_set(info, '$.seg', ?, '$.off', ?, '$.len', ?)"
+                                     " WHERE id = ?", (new["seg"], new["off"], new["len"], item_id))
+            finally:
+                segments_settled(new for _, new in moved.values())
+            if keep:
+                continue
+            # nothing references it any more, and the lock keeps new slots out
+            path.unlink(missing_ok=True)
+            reclaimed += st.st_size - used.get(path.name, 0)
+    return reclaimed
+
+def compact_segments_background():
+    threading.Thread(target=compact_segments, name="segment-compaction", daemon=True).start()
+
+# --- deduplicating chunk store ---
+# Files are cut at content-defined boundaries (gear rolling hash), so an insert
+# or edit only changes the chunks around it. Each chunk is named by a hash keyed
+# with the token's data key and stored once, encrypted, under CHUNKS_DIR; items
+# list their chunk ids and meta keeps a per-token refcount.
+# The hash only sees the last 64 bytes, so with numpy it is computed for a whole
+# read at once; without numpy chunks fall back to a fixed CDC_AVG (a per-byte
+# Python loop runs at a few MB/s and holds the GIL).
+_gear_rng = random.Random(0x5AFE)
+_GEAR = [_gear_rng.getrandbits(64) for _ in range(256)]
+_MASK64 = (1 << 64) - 1
+_gear_np = None  # _GEAR as a numpy array, False without numpy (imported on first use)
+
+def _gear_table():
+    global _gear_np
+    if _gear_np is None:
+        try:
+            import numpy as np
+        except ImportError:
+            _gear_np = False
+        else:
+            _gear_np = np.array(_GEAR, dtype=np.uint64)
+    return _gear_np
+
+def _gear_hits(buf, avg_size: int, begin: int = 0, block: int = 64 * 1024):
+    """Sorted offsets i >= begin at which the gear hash of the 64 bytes ending at buf[i] asks for a cut."""
+    import numpy as np
+    gear = _gear_table()
+    data = np.frombuffer(buf, dtype=np.uint8)
+    limit = np.uint64(1 << (64 - (avg_size.bit_length() - 1)))
+    hits = []
+    for s in range(begin, len(data), block):  # cache-sized blocks, each with the 63 bytes before it
+        lo = max(0, s - 63)
+        h = gear[data[lo:s + block]]
+        w = 1
+        while w < 64:  # widen the window from w to 2w bytes: h[i] += h[i-w] << w
+            h[w:] += h[:-w] << np.uint64(w)
+            w *= 2
+        hits.append(np.flatnonzero(h[s - lo:] < limit) + s)
+    del data  # release the export so the caller can resize buf
+    return np.concatenate(hits) if hits else np.zeros(0, dtype=np.intp)
+
+def _cdc_cut(buf, start: int, hits, min_size: int, avg_size: int, max_size: int) -> int:
+    """End of the chunk starting at buf[start]; same cut points as hashing byte by byte from start + min_size."""
+    n = min(len(buf), start + max_size)
+    lo = start + min_size
+    if n <= lo:
+        return n
+    # the hash restarts at lo, so its first 63 values differ from the windowed ones
+    shift = 64 - (avg_size.bit_length() - 1)
+    gear = _GEAR
+    h = 0
+    exact = min(n, lo + 63)
+    for i in range(lo, exact):
+        h = ((h << 1) + gear[buf[i]]) & _MASK64
+        if not h >> shift:
+            return i + 1
+    k = hits.searchsorted(exact)
+    if k < len(hits) and hits[k] < n:
+        return int(hits[k]) + 1
+    return n
+
+def iter_cdc_chunks(fin, min_size: int = CDC_MIN, avg_size: int = CDC_AVG, max_size: int = CDC_MAX):
+    cdc = _gear_table() is not False
+    if cdc:
+        import numpy as np
+        hits = np.zeros(0, dtype=np.intp)
+    buf = bytearray()
+    eof = False
+    while not eof:
+        data = fin.read(STREAM_CHUNK_SIZE)
+        eof = not data
+        hashed = len(buf)
+        buf += data
+        if cdc:  # hash only the new bytes; hits of the kept tail carry over
+            hits = np.concatenate((hits, _gear_hits(buf, avg_size, hashed)))
+        if len(buf) < max_size and not eof:
+            continue
+        start = 0
+        while len(buf) - start >= max_size or (eof and start < len(buf)):
+            cut = _cdc_cut(buf, start, hits, min_size, avg_size, max_size) if cdc else min(len(buf), start + avg_size)
+            yield bytes(buf[start:cut])
+            start = cut
+        del buf[:start]
+        if cdc:
+            hits = hits[hits.searchsorted(start):] - start
+
+def _chunk_id_key(key: bytes) -> bytes:
+    return hmac.new(key, b"safekey-dedup-chunk-id", hashlib.sha256).digest()
+
+def _chunk_path(chunk_id: str) -> Path:
+    return CHUNKS_DIR / chunk_id[:2] / chunk_id
+
+def seal_file_dedup(key: bytes, src: Path) -> list:
+    """
+    Chunk and encrypt src into the chunk store; returns its chunk ids in order.
+    Chunks already present are not encrypted or written again. Refcounts are left
+    to the caller (meta is only written from the thread owning the batch).
+    """
+    id_key = _chunk_id_key(key)
+    ids = []
+    with open(src, "rb") as fin:
+        for chunk in iter_cdc_chunks(fin):
+            cid = hashlib.blake2b(chunk, key=id_key, digest_size=20).hexdigest()
+            path = _chunk_path(cid)
+            if not path.exists():
+                path.parent.mkdir(exist_ok=True)
+                tmp = _tmp_sibling(path)
+                tmp.write_bytes(encrypt_blob(key, chunk))
+                os.replace(tmp, path)
+            ids.append(cid)
+    return ids
+
+def delete_chunks(chunk_ids):
+    for cid in chunk_ids:
+        _chunk_path(cid).unlink(missing_ok=True)
+
+# --- revealed-file fingerprints ---
+# reveal records {"size", "mtime_ns", "ino", "hash"} per item so hide can tell a
+# file nobody touched (just wipe it; the vault blob is still current) from one
+# that was edited and needs re-sealing
+def _fingerprint(path: Path, content_hash: str) -> dict:
+    st = path.stat()
+    return {"size": st.st_size, "mtime_ns": st.st_mtime_ns, "ino": st.st_ino, "hash": content_hash}
+
+def _unchanged_since_reveal(path: Path, fp: dict, verify_hash: bool) -> bool:
+    st = path.stat()
+    if (st.st_size, st.st_mtime_ns, st.st_ino) != (fp["size"], fp["mtime_ns"], fp["ino"]):
+        return False
+    if not verify_hash:
+        return True
+    h = _content_hash()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(STREAM_CHUNK_SIZE), b""):
+            h.update(block)
+    return h.hexdigest() == fp["hash"]
 
 # --- USB detection helpers ---
 def detect_mounted_tokens():
@@ -63,6 +1462,7 @@ def detect_mounted_tokens():
     Backward compatible: returns dict {token: mount}
     (same behavior as older code)
     """
+    import psutil
     tokens = {}
     for part in psutil.disk_partitions(all=False):
         try:
@@ -75,130 +1475,652 @@ def detect_mounted_tokens():
             continue
     return tokens
 
-def list_all_usb_drives():
+def _read_token_file(mount: Path):
+    try:
+        tf = mount / ".safekey_token"
+        if tf.exists():
+            return tf.read_bytes().strip().decode()
+    except Exception:
+        pass
+    return None
+
+def _usb_partitions():
+    """Yield (device, mountpoint) of partitions that look like removable/USB mounts."""
+    import psutil
+    sysname = platform.system()
+    for part in psutil.disk_partitions(all=False):
+        mount = str(Path(part.mountpoint))
+        if sysname == "Windows":
+            # Exclude system drive (typically C:\). Accept other drives.
+            system_drive = os.environ.get("SystemDrive", "C:\\")
+            if not mount.lower().startswith(system_drive.lower()):
+                yield part.device, mount
+        elif mount.startswith("/Volumes") or mount.startswith("/media"):
+            # macOS/linux: typical external mounts are under /Volumes or /media
+            yield part.device, mount
+    # On POSIX also list /Volumes and /media entries psutil might miss
+    if sysname != "Windows":
+        for base in ("/Volumes", "/media"):
+            try:
+                names = sorted(os.listdir(base)) if os.path.isdir(base) else []
+            except OSError:
+                continue
+            for name in names:
+                yield None, os.path.join(base, name)
+
+def _mount_ids() -> dict:
+    """Map mountpoint -> MOUNTINFO mount ID (new for every mount, even of the same device), or {}."""
+    try:
+        with open(MOUNTINFO, "rb") as f:
+            lines = f.read().decode("utf-8", "replace").splitlines()
+    except OSError:
+        return {}
+    ids = {}
+    for line in lines:
+        fields = line.split()
+        if len(fields) > 4:
+            # mountinfo escapes space, tab, newline and backslash as \ooo
+            mount = re.sub(r"\\([0-7]{3})", lambda m: chr(int(m.group(1), 8)), fields[4])
+            ids[mount] = fields[0]  # the last (topmost) mount of a path wins
+    return ids
+
+class DriveRegistry:
+    """
+    Cached answer for list_all_usb_drives().
+    Entries are keyed by (device, st_dev, mount, mount ID) and remember the
+    token read from that mount, so .safekey_token is only read again for a new
+    mount: another stick on the same device node and mountpoint still gets a
+    new MOUNTINFO mount ID. Where there is no MOUNTINFO, the tokens of mounts
+    that appeared or vanished in the listing are dropped on each change.
+    The cached list is reused until the mount table changes (MOUNTINFO
+    events on Linux, the partition/mount-dir listing elsewhere) or
+    invalidate() is called, e.g. after provisioning.
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._entries = {}      # (device, st_dev, mount, mount_id) -> (label, token)
+        self._drives = None     # last list handed out
+        self._signature = None
+        self._stale = set()     # mounts whose cached token must be re-read (no MOUNTINFO)
+        self._watch = None
+        self._poller = None
+
+    def invalidate(self):
+        """Forget the cached list and tokens; the next call rescans."""
+        with self._lock:
+            self._drives = None
+            self._entries = {}
+
+    def _mounts_changed(self) -> bool:
+        if self._watch is None and self._signature is None:
+            self._watch = open_mount_watch()
+            if self._watch is not None:
+                self._poller = select.poll()
+                self._poller.register(self._watch.fileno(), select.POLLPRI | select.POLLERR)
+        if self._watch is not None:
+            if not self._poller.poll(0):
+                return False
+            rearm_mount_watch(self._watch)
+            return True
+        # no mount events here: compare a cheap listing instead of re-reading tokens
+        signature = tuple(_usb_partitions())
+        changed = signature != self._signature
+        if changed and self._signature is not None:
+            self._stale |= {mount for _, mount in set(signature) ^ set(self._signature)}
+        self._signature = signature
+        return changed
+
+    def _scan(self):
+        drives = []
+        entries = {}
+        seen = set()    # (st_dev, st_ino) of mounts already listed
+        mount_ids = _mount_ids()
+        for device, mount in _usb_partitions():
+            try:
+                st = os.stat(mount)
+            except OSError:
+                continue
+            if (st.st_dev, st.st_ino) in seen:
+                continue
+            seen.add((st.st_dev, st.st_ino))
+            key = (device, st.st_dev, mount, mount_ids.get(mount))
+            ent = None if mount in self._stale else self._entries.get(key)
+            if ent is None:
+                p = Path(mount)
+                ent = (p.name if p.name else mount, _read_token_file(p))
+            entries[key] = ent
+            drives.append((mount, ent[0], ent[1]))
+        self._entries = entries
+        self._stale = set()
+        return drives
+
+    def drives(self, refresh: bool = False):
+        with self._lock:
+            changed = self._mounts_changed()
+            if refresh:
+                self._entries = {}
+                self._drives = None
+            if self._drives is None or changed:
+                self._drives = self._scan()
+            return list(self._drives)
+
+_drive_registry = DriveRegistry()
+
+def list_all_usb_drives(refresh: bool = False):
     """
     Return list of tuples: (mountpoint, friendly_label, token_or_None)
     - Scans partitions and heuristically includes removable/USB-like mounts.
     - On mac/linux also scans /Volumes and /media to catch mounts psutil might miss.
+    - Served from the DriveRegistry cache while the mount table is unchanged;
+      refresh=True rescans and re-reads every token file.
     """
-    drives = []
-    sysname = platform.system()
+    return _drive_registry.drives(refresh)
 
-    # Use psutil to enumerate partitions first
-    for part in psutil.disk_partitions(all=False):
-        try:
-            mount = Path(part.mountpoint)
-            # Heuristics for USB-like mounts
-            is_usb_like = False
-            if sysname == "Windows":
-                # Exclude system drive (typically C:\). Accept other drives.
-                system_drive = os.environ.get("SystemDrive", "C:\\")
-                if not str(mount).lower().startswith(system_drive.lower()):
-                    is_usb_like = True
+# --- mount events ---
+def open_mount_watch():
+    """
+    Open MOUNTINFO for change notification, or return None where it isn't available.
+    The fd reports POLLPRI/POLLERR after each mount or unmount; call
+    rearm_mount_watch() after an event before waiting again.
+    """
+    if not hasattr(select, "poll") or not os.path.exists(MOUNTINFO):
+        return None
+    try:
+        f = open(MOUNTINFO, "rb")
+        f.read()
+        return f
+    except OSError:
+        return None
+
+def rearm_mount_watch(f):
+    f.seek(0)
+    f.read()
+
+def watch_tokens(interval: float = POLL_INTERVAL):
+    """
+    Yield ("insert" | "remove", token, mount) as provisioned USBs come and go.
+    Blocks on mount-table events on Linux (no work while nothing changes) and
+    falls back to rescanning every `interval` seconds elsewhere.
+    """
+    watch = open_mount_watch()
+    poller = None
+    if watch is not None:
+        poller = select.poll()
+        poller.register(watch.fileno(), select.POLLPRI | select.POLLERR)
+    known = {}
+    try:
+        while True:
+            tokens = detect_mounted_tokens()
+            for tok, mount in tokens.items():
+                if tok not in known:
+                    yield "insert", tok, mount
+            for tok, mount in known.items():
+                if tok not in tokens:
+                    yield "remove", tok, mount
+            known = tokens
+            if poller is None:
+                time.sleep(interval)
             else:
-                # macOS/linux: typical external mounts are under /Volumes or /media
-                if str(mount).startswith("/Volumes") or str(mount).startswith("/media"):
-                    is_usb_like = True
-                # also accept mounts that look like removable (fallback)
-                # skip root and common system mounts
-                if str(mount) in ("/", "/home", "/boot", "/mnt"):
-                    is_usb_like = is_usb_like and False
-
-            # friendly label
-            label = mount.name if mount.name else str(mount)
-
-            # token presence
-            token = None
-            try:
-                token_path = mount / ".safekey_token"
-                if token_path.exists():
-                    token = token_path.read_bytes().strip().decode()
-            except Exception:
-                token = None
+                poller.poll()
+                rearm_mount_watch(watch)
+    finally:
+        if watch is not None:
+            watch.close()
 
-            if is_usb_like:
-                drives.append((str(mount), label, token))
-        except Exception:
-            continue
+# --- secure delete ---
+FALLOC_FL_KEEP_SIZE = 0x01
+FALLOC_FL_PUNCH_HOLE = 0x02
+_ZEROS = bytes(WIPE_BUFFER)
 
-    # Fallback: on POSIX systems, ensure /Volumes and /media entries are included
-    if sysname != "Windows":
-        for base in ("/Volumes", "/media"):
-            try:
-                if not os.path.isdir(base):
-                    continue
-                for name in sorted(os.listdir(base)):
-                    mp = Path(base) / name
-                    if not mp.exists():
-                        continue
-                    # avoid duplicates
-                    if any(Path(d[0]).samefile(mp) for d in drives if Path(d[0]).exists()):
-                        continue
-                    token = None
-                    try:
-                        tf = mp / ".safekey_token"
-                        if tf.exists():
-                            token = tf.read_bytes().strip().decode()
-                    except Exception:
-                        token = None
-                    drives.append((str(mp), mp.name, token))
-            except Exception:
-                pass
+def _wipe_buffer(pattern) -> bytes:
+    if pattern == "random":
+        return os.urandom(WIPE_BUFFER)
+    if pattern == b"\x00":
+        return _ZEROS
+    return pattern * WIPE_BUFFER
+
+def _punch_hole(fd: int, size: int) -> bool:
+    """Deallocate the whole file range (Linux fallocate); False if the fs can't."""
+    if not sys.platform.startswith("linux"):
+        return False
+    try:
+        import ctypes
+        libc = ctypes.CDLL(None, use_errno=True)
+        fallocate = libc.fallocate
+        fallocate.argtypes = [ctypes.c_int, ctypes.c_int, ctypes.c_int64, ctypes.c_int64]
+        return fallocate(fd, FALLOC_FL_PUNCH_HOLE | FALLOC_FL_KEEP_SIZE, 0, size) == 0
+    except (OSError, AttributeError):
+        return False
 
-    # Deduplicate by mountpoint, keep first occurrence
-    seen = set()
-    out = []
-    for mount, label, token in drives:
-        if mount not in seen:
-            out.append((mount, label, token))
-            seen.add(mount)
-    return out
+def _overwrite_direct(path: Path, size: int, progress, cancel) -> bool:
+    """One zero pass with O_DIRECT, bypassing the page cache; None if unsupported."""
+    if not hasattr(os, "O_DIRECT"):
+        return None
+    try:
+        fd = os.open(path, os.O_WRONLY | os.O_DIRECT)
+    except OSError:
+        return None
+    buf = mmap.mmap(-1, WIPE_BUFFER)  # page aligned, zero filled
+    try:
+        done = 0
+        while done < size:
+            if cancel is not None and cancel.is_set():
+                return False
+            # O_DIRECT needs block-sized writes; the tail is rounded up and truncated below
+            n = min(WIPE_BUFFER, (size - done + 4095) // 4096 * 4096)
+            os.write(fd, memoryview(buf)[:n])
+            done += n
+            if progress:
+                progress(min(done, size), size)
+        os.ftruncate(fd, size)
+        os.fsync(fd)
+        return True
+    except OSError:
+        return None
+    finally:
+        buf.close()
+        os.close(fd)
 
-# --- secure delete ---
-def secure_delete_file(path: Path):
+@metrics.span("delete")
+def secure_delete_file(path: Path, passes=None, fast: bool = None, progress=None, cancel=None) -> bool:
+    """
+    Overwrite a file in place, then unlink it.
+    passes (default WIPE_PASSES) are streamed through a fixed WIPE_BUFFER, so memory
+    use doesn't grow with file size. fast (default WIPE_FAST) first tries to punch
+    the whole range out of the file (the fs deallocates/discards the blocks rather
+    than rewriting them), then a single O_DIRECT zero pass, before the buffered path.
+    progress(bytes_done, bytes_total) is called as the overwrite advances; setting
+    the cancel Event stops it and leaves the file in place. Returns True if deleted.
+    """
+    passes = WIPE_PASSES if passes is None else passes
+    fast = WIPE_FAST if fast is None else fast
     try:
         if not path.exists() or not path.is_file():
-            return
+            return False
         size = path.stat().st_size
-        # overwrite once with zeros
-        with open(path, "br+") as f:
-            f.seek(0)
-            f.write(b'\x00' * size)
-            f.flush()
-            os.fsync(f.fileno())
+        wiped = None
+        if fast and size:
+            with open(path, "br+") as f:
+                if _punch_hole(f.fileno(), size):
+                    os.fsync(f.fileno())
+                    wiped = True
+            if wiped is None:
+                wiped = _overwrite_direct(path, size, progress, cancel)
+        if wiped is None:
+            total = size * len(passes)
+            done = 0
+            with open(path, "br+", buffering=0) as f:
+                for pattern in passes:
+                    buf = memoryview(_wipe_buffer(pattern))
+                    f.seek(0)
+                    left = size
+                    while left:
+                        if cancel is not None and cancel.is_set():
+                            return False
+                        n = f.write(buf[:min(left, WIPE_BUFFER)])
+                        left -= n
+                        done += n
+                        if progress:
+                            progress(done, total)
+                    os.fsync(f.fileno())
+            wiped = True
+        if not wiped:
+            return False
         path.unlink()
+        return True
     except Exception:
         # fallback: normal delete
         try:
             path.unlink()
+            return True
         except Exception:
-            pass
+            return False
 
 # --- core operations ---
 def provision(mountpoint: str):
     ensure_dirs()
+    import uuid
     token = uuid.uuid4().hex.encode()
     p = Path(mountpoint)
     if not p.exists():
         raise FileNotFoundError(f"Mountpoint not found: {mountpoint}")
     tfile = p / ".safekey_token"
     tfile.write_bytes(token)
-    meta = read_meta()
-    meta[token.decode()] = {"salt": base64.b64encode(secrets.token_bytes(16)).decode(), "items": []}
-    write_meta(meta)
+    _drive_registry.invalidate()
+    add_token(token.decode())
     print("Provisioned USB at", mountpoint, "token:", token.decode())
     return token.decode()
 
-def _save_vault_item(token_str: str, original_path: str, ciphertext: bytes):
-    vault_name = secrets.token_hex(20)
-    (VAULT_DIR / vault_name).write_bytes(ciphertext)
-    meta = read_meta()
-    if token_str not in meta:
-        meta[token_str] = {"salt": base64.b64encode(secrets.token_bytes(16)).decode(), "items": []}
-    meta[token_str]["items"].append({"vault": vault_name, "orig": original_path})
-    write_meta(meta)
+def _save_vault_item(token_str: str, original_path: str, sealed: dict):
+    """
+    Record a sealed file ({"vault", "fmt", ...} from _seal_new) as an item of token_str.
+    An existing entry for the same path is replaced and returned (its chunk refs
+    are dropped here; pass it to _release_storage() once committed), else None.
+    """
+    with meta_batch():
+        if not vault_tokens(token_str):
+            add_token(token_str)
+        old = find_item(token_str, original_path)
+        if sealed["fmt"] == DEDUP_FORMAT:
+            ref_chunks(token_str, sealed["chunks"], 1)
+        if old is None:
+            add_item(token_str, dict(sealed, orig=original_path))
+            return None
+        update_item(dict(sealed, id=old["id"], orig=original_path))
+        if old.get("fmt") == DEDUP_FORMAT:
+            ref_chunks(token_str, old["chunks"], -1)
+        return old
+
+def _release_storage(items, dead_chunks):
+    """Delete vault blobs of items that no longer exist, plus unreferenced chunks."""
+    delete_chunks(dead_chunks)
+    for item in items:
+        if item["vault"]:
+            (VAULT_DIR / item["vault"]).unlink(missing_ok=True)
+    if any("seg" in item for item in items):
+        compact_segments_background()
+
+def _unlock(token_str: str, password: str):
+    """Return the vault data key for a registered token, or None if the token is unknown or the password wrong."""
+    ent = get_token(token_str)
+    if ent is None:
+        return None
+    if ent["kek"] is None:
+        return _first_unlock(token_str, password)
+    params = ent["kek"].get("kdf") or LEGACY_KDF
+    from cryptography.exceptions import InvalidTag
+    kek = get_key(password, token_str, base64.b64decode(ent["kek"]["salt"]), params)
+    try:
+        dek = unwrap_key(kek, ent["kek"]["wrapped"], token_str)
+    except InvalidTag:
+        return None
+    policy = kdf_policy()
+    if params != policy:
+        # transparent upgrade (or downgrade to this machine's budget): rewrap with the current policy
+        set_token_kek(token_str, _new_kek(password, token_str, dek, policy))
+    return dek
+
+def _key_opens_vault(key: bytes, vault: str) -> bool:
+    """Check a key against the vault's items: True once one decrypts, False if one fails or none is left to try."""
+    rows = _db().execute("SELECT * FROM items WHERE token = ? ORDER BY id", (vault,)).fetchall()
+    for r in rows:
+        status = verify_item(key, _row_to_item(r))
+        if status != "missing":  # an item whose storage is gone proves nothing either way
+            return status == "ok"
+    return False
+
+def _first_unlock(token_str: str, password: str):
+    """Set up the wrapped DEK of a token that has none yet (new or pre-envelope)."""
+    ent = get_token(token_str)
+    vault = vault_of(token_str)
+    if _db().execute("SELECT 1 FROM items WHERE token = ? LIMIT 1", (vault,)).fetchone():
+        # existing vault: its items were sealed with the directly derived key
+        dek = get_key(password, token_str, base64.b64decode(ent["salt"]))
+        if not _key_opens_vault(dek, vault):
+            return None
+    else:
+        dek = secrets.token_bytes(32)
+    # KDF calibration and derivation stay outside the write lock; only the store is transactional
+    kek = _new_kek(password, token_str, dek)
+    with meta_batch():
+        won = get_token(token_str)["kek"] is None
+        if won:
+            set_token_kek(token_str, kek)
+    if not won:  # another thread/process got here first
+        return _unlock(token_str, password)
+    return dek
+
+def change_password(token_str: str, old_password: str, new_password: str) -> int:
+    """
+    Rewrap the data key of every token of token_str's vault that old_password
+    opens under new_password. Returns the number of tokens rewrapped.
+    """
+    dek = _unlock(token_str, old_password)
+    if dek is None:
+        return 0
+    # unlock and derive first; the transaction only swaps rows that are still as read
+    policy = kdf_policy()
+    rewrap = {}  # token -> (kek it had, kek under new_password)
+    for tok in vault_tokens(vault_of(token_str)):
+        if tok == token_str or _unlock(tok, old_password) == dek:
+            ent = get_token(tok)
+            rewrap[tok] = (ent["kek"], _new_kek(new_password, tok, dek, policy))
+    changed = 0
+    with meta_batch():
+        for tok, (old, new) in rewrap.items():
+            ent = get_token(tok)
+            if ent is None or ent["kek"] != old:  # removed or rewrapped meanwhile
+                continue
+            set_token_kek(tok, new)
+            changed += 1
+    for tok in vault_tokens(vault_of(token_str)):
+        clear_key_cache(tok)
+    return changed
+
+def add_backup_token(token_str: str, password: str, mountpoint: str, replace: bool = False):
+    """
+    Provision the USB at mountpoint as another key to token_str's vault (same
+    password). With replace, token_str stops unlocking it. Returns the new token.
+    """
+    dek = _unlock(token_str, password)
+    if dek is None:
+        return None
+    p = Path(mountpoint)
+    if not p.exists():
+        raise FileNotFoundError(f"Mountpoint not found: {mountpoint}")
+    import uuid
+    new_token = uuid.uuid4().hex
+    vault = vault_of(token_str)
+    kek = get_token(token_str)["kek"]
+    new_kek = _new_kek(password, new_token, dek)  # derived before taking the write lock
+    # token file first: a failure here must not leave meta pointing at a USB that has no token
+    tfile = p / ".safekey_token"
+    tfile.write_bytes(new_token.encode())
+    _drive_registry.invalidate()
+    with meta_batch():
+        ent = get_token(token_str)
+        current = ent is not None and ent["kek"] == kek
+        if current:
+            add_token(new_token, vault=vault, kek=new_kek)
+            if replace:
+                remove_token(token_str)
+    if not current:  # its password changed or it was removed meanwhile
+        tfile.unlink(missing_ok=True)
+        print("Token changed while adding the backup; nothing added, try again")
+        return None
+    if replace:
+        clear_key_cache(token_str)
+    print(("Replaced token with" if replace else "Added backup token"), new_token, "at", mountpoint)
+    return new_token
+
+def _seal_new(key: bytes, fpath: Path, dedup: bool = False, vault_name: str = None) -> dict:
+    """Seal fpath as a new item; a large file goes to vault_name (default: a fresh name)."""
+    if dedup:
+        return {"vault": "", "fmt": DEDUP_FORMAT, "chunks": seal_file_dedup(key, fpath)}
+    if fpath.stat().st_size <= SMALL_FILE_LIMIT:
+        return seal_small_file(key, fpath)
+    vault_name = vault_name or secrets.token_hex(20)
+    codec, size = seal_file(key, fpath, VAULT_DIR / vault_name)
+    return _stream_item(vault_name, codec, size)
+
+def _stream_item(vault_name: str, codec, size: int) -> dict:
+    item = {"vault": vault_name, "fmt": STREAM_FORMAT, "size": size}
+    if codec:
+        item["codec"] = codec
+    return item
+
+def _apply_sealed(item: dict, sealed: dict):
+    """
+    Point an existing item at freshly sealed storage (from hide).
+    Returns (old chunk ids if it was re-chunked, else None; vault blob it no longer uses, or "").
+    """
+    old_chunks = item["chunks"] if "chunks" in sealed else None
+    drop = item["vault"] if item["vault"] and sealed.get("vault") != item["vault"] else ""
+    for k in ("codec", "seg", "off", "len", "size"):
+        item.pop(k, None)
+    item.update(sealed)
+    return old_chunks, drop
+
+# --- parallel pipeline ---
+class JobCancelled(Exception):
+    pass
+
+class JobControl:
+    """
+    Progress callback plus cancel/pause flags for a long operation.
+    Operations call checkpoint() between files: it blocks while paused and stops
+    new work once cancelled (files already in flight still finish and are recorded).
+    """
+    def __init__(self, progress=None):
+        self.progress = progress
+        self._cancelled = threading.Event()
+        self._running = threading.Event()
+        self._running.set()
+
+    def cancel(self):
+        self._cancelled.set()
+        self._running.set()
+
+    def pause(self):
+        self._running.clear()
+
+    def resume(self):
+        self._running.set()
+
+    @property
+    def cancelled(self) -> bool:
+        return self._cancelled.is_set()
+
+    @property
+    def paused(self) -> bool:
+        return not self._running.is_set()
+
+    def checkpoint(self) -> bool:
+        """Wait out a pause; return False once the job has been cancelled."""
+        self._running.wait()
+        return not self._cancelled.is_set()
+
+    def report(self, done: int, total: int = None):
+        if self.progress:
+            self.progress(done, total)
+
+def _submit(pool, fn, *args):
+    """pool.submit() that runs fn in a copy of the caller's context (metrics operation, daemon client)."""
+    return pool.submit(contextvars.copy_context().run, fn, *args)
+
+def _pipeline(pool, jobs, fn, max_pending: int, control: JobControl = None):
+    """
+    Submit fn(job) for each job and yield (job, future) as they complete.
+    At most max_pending jobs are in flight, so a lazy producer (os.walk) is only
+    pulled as fast as the workers drain it. With a control, submission pauses
+    with it and stops on cancel; jobs already submitted are still yielded.
+    """
+    from concurrent.futures import FIRST_COMPLETED, wait
+    inflight = {}
+    for job in jobs:
+        if control is not None and not control.checkpoint():
+            break
+        while len(inflight) >= max_pending:
+            done, _ = wait(inflight, return_when=FIRST_COMPLETED)
+            for fut in done:
+                yield inflight.pop(fut), fut
+        inflight[_submit(pool, fn, job)] = job
+    while inflight:
+        done, _ = wait(inflight, return_when=FIRST_COMPLETED)
+        for fut in done:
+            yield inflight.pop(fut), fut
+
+def iter_files(p: Path):
+    """Yield p itself if it is a file, else every file below it."""
+    if p.is_file():
+        yield p
+        return
+    for root, dirs, files in os.walk(p):
+        for fname in files:
+            yield Path(root) / fname
+
+@metrics.operation("assign")
+def assign_files(token_str: str, key: bytes, files, workers: int = None, dedup: bool = None,
+                 control: JobControl = None):
+    """
+    Encrypt files into the vault on a worker pool and record them in meta.
+    Metadata is committed every ASSIGN_BATCH files; originals are only wiped after
+    the commit that references them. Every file is journaled (see recover_journal),
+    and leftovers of an interrupted run for this token are settled first. dedup (default DEDUP) stores files in the
+    shared chunk store. control reports (files done, None) and can pause/cancel.
+    Returns (assigned_count, [(path, error), ...]).
+    """
+    workers = workers or WORKERS
+    if dedup is None:
+        dedup = DEDUP
+    token_str = vault_of(token_str)
+    recover_journal(token_str)
+    errors = []
+    sealed = []
+    wipes = []
+    assigned = 0
+
+    def seal(fpath):
+        if fpath.stat().st_size <= SMALL_FILE_LIMIT:
+            # cheap to redo and lands in a segment (dead space if lost); journaled at commit
+            return None, _seal_new(key, fpath, dedup)
+        # journaled before anything is written, so a crash can't orphan the blob
+        vault_name = secrets.token_hex(20)
+        jid = journal_begin("assign", token_str, fpath, vault_name)
+        try:
+            item = _seal_new(key, fpath, dedup, vault_name)
+        except BaseException:
+            _journal_rollback(token_str, jid, {"vault": vault_name})
+            raise
+        journal_sealed(jid, item)
+        return jid, item
+
+    def finish_wipes(block: bool):
+        done, pending = [], []
+        for w in wipes:
+            (done if block or w[2].done() else pending).append(w)
+        wipes[:] = pending
+        with meta_batch():
+            journal_done([jid for jid, fpath, fut in done if _wipe_done(fpath, fut.result())])
+
+    from concurrent.futures import ThreadPoolExecutor
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        def commit():
+            replaced = []
+            with meta_batch():
+                for entry in sealed:
+                    fpath, jid, item = entry
+                    old = _save_vault_item(token_str, str(fpath), item)
+                    if jid is None:
+                        entry[1] = journal_begin("assign", token_str, fpath, state="committed")
+                    else:
+                        journal_committed(jid)
+                    if old is not None:
+                        replaced.append(old)
+                dead = pop_dead_chunks(token_str) if replaced else []
+            segments_settled(item for _, _, item in sealed)
+            _release_storage(replaced, dead)
+            wipes.extend((jid, fpath, _submit(pool, secure_delete_file, fpath)) for fpath, jid, _ in sealed)
+            sealed.clear()
+            finish_wipes(block=False)
+
+        for fpath, fut in _pipeline(pool, files, seal, workers * 2, control):
+            try:
+                sealed.append([fpath, *fut.result()])
+                assigned += 1
+            except Exception as e:
+                errors.append((str(fpath), e))
+            if control is not None:
+                control.report(assigned + len(errors))
+            if len(sealed) >= ASSIGN_BATCH:
+                commit()
+        commit()
+        finish_wipes(block=True)
+    metrics.add("items.assigned", assigned)
+    metrics.add("items.failed", len(errors))
+    return assigned, errors
 
-def assign_path(path_str: str, password: str):
+def assign_path(path_str: str, password: str, dedup: bool = None):
     ensure_dirs()
     tokens = detect_mounted_tokens()
     if not tokens:
@@ -206,153 +2128,699 @@ def assign_path(path_str: str, password: str):
         return
     # choose first token (can improve to ask user)
     token_str, mount = next(iter(tokens.items()))
-    token_bytes = token_str.encode()
-    meta = read_meta()
-    if token_str not in meta:
-        print("Token not registered in meta. Re-provision.")
+    key = _unlock(token_str, password)
+    if key is None:
+        print("Token not registered in meta (re-provision) or wrong password.")
         return
-    salt = base64.b64decode(meta[token_str]["salt"])
-    key = derive_key(password, token_bytes, salt)
 
-    p = Path(path_str)
+    p = Path(os.path.abspath(path_str))
     if not p.exists():
         print("Path does not exist:", path_str); return
 
+    # folders: recursively encrypt files inside, keep directory structure metadata
+    assigned, errors = assign_files(token_str, key, iter_files(p), dedup=dedup)
+    for fpath, e in errors:
+        print("Failed to assign:", fpath, e)
     if p.is_file():
-        data = p.read_bytes()
-        ct = encrypt_blob(key, data)
-        _save_vault_item(token_str, str(p), ct)
-        secure_delete_file(p)
         print("Assigned file to USB key and hidden:", p)
     else:
-        # folder: recursively encrypt files inside, keep directory structure metadata
-        for root, dirs, files in os.walk(p):
-            for fname in files:
-                fpath = Path(root) / fname
-                data = fpath.read_bytes()
-                ct = encrypt_blob(key, data)
-                _save_vault_item(token_str, str(fpath), ct)
-                secure_delete_file(fpath)
-        print("Assigned folder (contents encrypted) to USB key:", p)
-
-def reveal_for_token(token_str: str, password: str):
+        print(f"Assigned folder ({assigned} files encrypted) to USB key:", p)
+    return assigned, errors
+
+def _reveal_item(key: bytes, item: dict):
+    """Restore one item; returns its fingerprint, or None if the vault blob is missing."""
+    if item.get("fmt") == DEDUP_FORMAT:
+        missing = [cid for cid in item["chunks"] if not _chunk_path(cid).exists()]
+        if missing:
+            print("Missing vault chunks:", ", ".join(missing))
+            return None
+    elif "seg" in item:
+        if not (SEGMENTS_DIR / item["seg"]).exists() and not _follow_segment(item):
+            print("Missing vault segment:", item["seg"])
+            return None
+    elif not (VAULT_DIR / item["vault"]).exists():
+        print("Missing vault blob:", item["vault"])
+        return None
+    orig_path = Path(item["orig"])
+    orig_path.parent.mkdir(parents=True, exist_ok=True)
+    if orig_path.exists():
+        print("Warning: original path exists already. Overwriting:", orig_path)
+    return _fingerprint(orig_path, unseal_file(key, item, orig_path))
+
+@metrics.operation("reveal")
+def reveal_for_token(token_str: str, password: str, control: JobControl = None, subpath: str = None):
+    """Restore the token's items (only those at or below subpath, if given)."""
     ensure_dirs()
-    meta = read_meta()
-    if token_str not in meta:
-        print("Unknown token")
+    key = _unlock(token_str, password)
+    if key is None:
+        print("Unknown token or wrong password")
         return
-    salt = base64.b64decode(meta[token_str]["salt"])
-    key = derive_key(password, token_str.encode(), salt)
+    token_str = vault_of(token_str)
     restored = []
-    for item in list(meta[token_str]["items"]):
-        vault_file = VAULT_DIR / item["vault"]
-        if not vault_file.exists():
-            print("Missing vault blob:", item["vault"]); continue
-        try:
-            plaintext = decrypt_blob(key, vault_file.read_bytes())
-        except Exception:
-            print("Decryption failed for item, maybe wrong password or token mismatch:", item["orig"])
-            continue
-        orig_path = Path(item["orig"])
-        orig_path.parent.mkdir(parents=True, exist_ok=True)
-        if orig_path.exists():
-            print("Warning: original path exists already. Overwriting:", orig_path)
-        orig_path.write_bytes(plaintext)
-        restored.append(str(orig_path))
+    items = list_items(token_str, subpath)
+    revealed = []
+
+    def commit():
+        # fingerprints are committed in batches so other writers aren't locked out for the whole reveal
+        with meta_batch():
+            for item in revealed:
+                set_item_fp(item["id"], item["fp"])
+        revealed.clear()
+
+    from concurrent.futures import ThreadPoolExecutor
+    with ThreadPoolExecutor(max_workers=WORKERS) as pool:
+        for n, (item, fut) in enumerate(_pipeline(pool, items, lambda it: _reveal_item(key, it), WORKERS * 2, control), 1):
+            try:
+                fp = fut.result()
+            except Exception:
+                print("Decryption failed for item, maybe wrong password or token mismatch:", item["orig"])
+                fp = None
+            if fp is not None:
+                item["fp"] = fp
+                revealed.append(item)
+                restored.append(item["orig"])
+                if len(revealed) >= ASSIGN_BATCH:
+                    commit()
+            if control is not None:
+                control.report(n, len(items))
+        commit()
+    metrics.add("items.revealed", len(restored))
     print("Revealed {} items for token {}".format(len(restored), token_str))
     return restored
 
-def hide_for_token(token_str: str, password: str):
+@metrics.operation("hide")
+def hide_for_token(token_str: str, password: str, verify_hash: bool = None, control: JobControl = None,
+                   subpath: str = None):
     """
-    Re-scan meta for items and re-encrypt anything that currently exists on disk at orig path.
+    Re-scan meta for items and re-hide anything that currently exists on disk at orig path.
     (useful on USB removal to re-hide any revealed files)
+    subpath limits this to items at or below that path.
+    Files whose reveal fingerprint still matches are wiped without re-encrypting;
+    verify_hash (default HIDE_VERIFY_HASH) also compares their content hash.
+    Edited files are sealed to new storage under the batch journal, so a crash
+    never leaves an item pointing at a half-written blob.
+    control reports (items done, items total) and can pause/cancel.
     """
     ensure_dirs()
-    meta = read_meta()
-    if token_str not in meta:
-        print("Unknown token"); return
-    salt = base64.b64decode(meta[token_str]["salt"])
-    key = derive_key(password, token_str.encode(), salt)
-    for item in list(meta[token_str]["items"]):
+    key = _unlock(token_str, password)
+    if key is None:
+        print("Unknown token or wrong password"); return
+    token_str = vault_of(token_str)
+    if verify_hash is None:
+        verify_hash = HIDE_VERIFY_HASH
+
+    recover_journal(token_str)
+
+    def rehide(item):
         orig_path = Path(item["orig"])
-        if orig_path.exists() and orig_path.is_file():
-            data = orig_path.read_bytes()
-            ct = encrypt_blob(key, data)
-            (VAULT_DIR / item["vault"]).write_bytes(ct)
-            secure_delete_file(orig_path)
-            print("Re-hidden:", orig_path)
+        if not (orig_path.exists() and orig_path.is_file()):
+            return None, None, None
+        fp = item.get("fp")
+        if fp and _unchanged_since_reveal(orig_path, fp, verify_hash):
+            return "unchanged", None, None
+        # edited files get new storage; the old blob stays valid until the commit
+        dedup = item.get("fmt") == DEDUP_FORMAT
+        if orig_path.stat().st_size <= SMALL_FILE_LIMIT:
+            # cheap to redo; journaled at commit (as assign does)
+            return "sealed", {"chunks": seal_file_dedup(key, orig_path)} if dedup else _seal_new(key, orig_path), None
+        vault_name = "" if dedup else secrets.token_hex(20)
+        jid = journal_begin("hide", token_str, orig_path, vault_name, item["id"])
+        try:
+            if dedup:
+                sealed = {"chunks": seal_file_dedup(key, orig_path)}
+            else:
+                # small: a new segment slot, else a new vault file
+                sealed = _seal_new(key, orig_path, vault_name=vault_name)
+        except BaseException:
+            _journal_rollback(token_str, jid, {"vault": vault_name})
+            raise
+        journal_sealed(jid, sealed)
+        return "sealed", sealed, jid
+
+    from concurrent.futures import ThreadPoolExecutor
+    with ThreadPoolExecutor(max_workers=WORKERS) as pool:
+        hidden = []
+        touched = []   # re-sealed: new storage location
+        cleared = []   # unchanged or gone: only the fingerprint is dropped
+        new_slots = []
+        rechunked = []
+        items = list_items(token_str, subpath)
+        for n, (item, fut) in enumerate(_pipeline(pool, items, rehide, WORKERS * 2, control), 1):
+            if control is not None:
+                control.report(n, len(items))
+            try:
+                outcome, sealed, jid = fut.result()
+            except Exception as e:
+                print("Failed to re-hide:", item["orig"], e)
+                continue
+            had_fp = item.pop("fp", None) is not None
+            drop = ""
+            if sealed:
+                old_chunks, drop = _apply_sealed(item, sealed)
+                if old_chunks is not None:
+                    rechunked.append((old_chunks, sealed["chunks"]))
+                touched.append(item)
+                new_slots.append(sealed)
+            elif had_fp:
+                cleared.append(item["id"])
+            if outcome:
+                hidden.append([jid, item, outcome, drop])
+        with meta_batch():
+            for item in touched:
+                update_item(item)
+            for item_id in cleared:
+                set_item_fp(item_id)
+            for old_chunks, new_chunks in rechunked:
+                ref_chunks(token_str, new_chunks, 1)
+                ref_chunks(token_str, old_chunks, -1)
+            for h in hidden:
+                jid, item, outcome, drop = h
+                if jid is None:
+                    # unchanged or small files: only the wipe has to survive a crash
+                    h[0] = jid = journal_begin("hide", token_str, Path(item["orig"]), item_id=item["id"])
+                journal_committed(jid, drop)
+            dead = pop_dead_chunks(token_str)
+        segments_settled(new_slots)
+        delete_chunks(dead)
+        wipes = []
+        for jid, item, outcome, drop in hidden:
+            if drop:
+                (VAULT_DIR / drop).unlink(missing_ok=True)
+            path = Path(item["orig"])
+            wipes.append((jid, path, _submit(pool, secure_delete_file, path)))
+            print("Re-hidden:" if outcome == "sealed" else "Hidden (unchanged):", item["orig"])
+        wiped = [jid for jid, path, fut in wipes if _wipe_done(path, fut.result())]
+        with meta_batch():
+            journal_done(wiped)
+        for _, _, outcome, _ in hidden:
+            metrics.add("items.resealed" if outcome == "sealed" else "items.hidden_unchanged")
+    # re-sealed small files left dead space in older segments
+    compact_segments_background()
     print("Hide complete for token", token_str)
 
-# --- poller (simple) ---
+# --- gc / scrub ---
+# gc reconciles the vault directories with meta (no key needed); scrub
+# authenticates every AES-GCM tag of a token's items without writing plaintext
+# and records a per-item status, so damage shows up before a reveal needs the data.
+# Both write a summary into HEALTH_FILE.
+class _RateLimit:
+    """Token bucket shared by scrub workers: take(n) blocks to hold bytes/s under rate."""
+    def __init__(self, rate: float):
+        self.rate = rate
+        self.lock = threading.Lock()
+        self.next_free = time.monotonic()
+
+    def take(self, n: int):
+        if not self.rate:
+            return
+        with self.lock:
+            now = time.monotonic()
+            start = max(now, self.next_free)
+            self.next_free = start + n / self.rate
+        if start > now:
+            time.sleep(start - now)
+
+class _ThrottledReader:
+    def __init__(self, f, limit: _RateLimit):
+        self.f = f
+        self.limit = limit
+
+    def read(self, n: int = -1):
+        data = self.f.read(n)
+        self.limit.take(len(data))
+        return data
+
+class _NullWriter:
+    def write(self, data):
+        return len(data)
+
+def _update_health(section: str, value):
+    """Merge one section into HEALTH_FILE (tmp file + rename)."""
+    try:
+        report = json.loads(HEALTH_FILE.read_text())
+    except (OSError, ValueError):
+        report = {}
+    if section == "tokens":
+        report.setdefault("tokens", {}).update(value)
+    else:
+        report[section] = value
+    report["updated"] = time.strftime("%Y-%m-%dT%H:%M:%S")
+    tmp = _tmp_sibling(HEALTH_FILE)
+    tmp.write_text(json.dumps(report, indent=2, sort_keys=True))
+    os.replace(tmp, HEALTH_FILE)
+
+def gc_vault(grace: float = GC_GRACE, rate_mbps: float = None) -> dict:
+    """
+    Delete vault blobs, chunks and temp files nothing references any more, drop
+    dead chunk refcounts and compact segments, copying at most rate_mbps MB/s
+    (default GC_MBPS). Returns (and records) the counts.
+    """
+    ensure_dirs()
+    conn = _db()
+    cutoff = time.time() - grace
+    keep = {r["vault"] for r in conn.execute("SELECT DISTINCT vault FROM items WHERE vault != ''")}
+    live_chunks = {r["id"] for r in conn.execute("SELECT id FROM chunks WHERE refs > 0")}
+    for r in conn.execute("SELECT plan, sealed FROM journal"):
+        plan = json.loads(r["plan"])
+        keep.update(v for v in (plan.get("vault"), plan.get("drop")) if v)
+        if r["sealed"]:
+            live_chunks.update(json.loads(r["sealed"]).get("chunks", []))
+    stats = {"orphan_blobs": 0, "orphan_chunks": 0, "bytes_freed": 0}
+
+    def drop(path: Path, kind: str):
+        try:
+            st = path.stat()
+            if st.st_mtime > cutoff:
+                return
+            path.unlink()
+        except OSError:
+            return
+        stats[kind] += 1
+        stats["bytes_freed"] += st.st_size
+
+    present = set()  # names seen while scanning, so the missing-storage count needs no stat per chunk
+    for entry in os.scandir(VAULT_DIR):
+        if not entry.is_file():
+            continue
+        name = entry.name
+        present.add(name)
+        if name.endswith(".tmp") or name not in keep:
+            drop(Path(entry.path), "orphan_blobs")
+    with meta_batch():
+        for r in conn.execute("SELECT DISTINCT token FROM chunks WHERE refs <= 0").fetchall():
+            pop_dead_chunks(r["token"])
+    for sub in os.scandir(CHUNKS_DIR):
+        if not sub.is_dir():
+            continue
+        for entry in os.scandir(sub.path):
+            if entry.name.endswith(".tmp") or entry.name not in live_chunks:
+                drop(Path(entry.path), "orphan_chunks")
+            else:
+                present.add(entry.name)
+    rate = (GC_MBPS if rate_mbps is None else rate_mbps) * 1024 * 1024
+    stats["bytes_freed"] += compact_segments(limit=_RateLimit(rate))
+    present.update(os.listdir(SEGMENTS_DIR))
+    missing = 0
+    for r in conn.execute("SELECT * FROM items"):
+        item = _row_to_item(r)
+        names = item.get("chunks") or [item.get("seg") or item["vault"]]
+        # only what the listings missed is looked up again (it may have been written since)
+        if not all(n in present for n in names) and not _sealed_present(item):
+            missing += 1
+    stats["items_missing_storage"] = missing
+    stats["finished"] = time.strftime("%Y-%m-%dT%H:%M:%S")
+    _update_health("gc", stats)
+    return stats
+
+def verify_item(key: bytes, item: dict, limit: _RateLimit = None, seen_chunks: set = None) -> str:
+    """
+    Authenticate every ciphertext byte of an item; plaintext is discarded.
+    Returns "ok", "missing" or "corrupt". Chunk ids in seen_chunks are skipped
+    and verified ones are added to it.
+    """
+    limit = limit or _RateLimit(0)
+    sink = _NullWriter()
+    try:
+        if item.get("fmt") == DEDUP_FORMAT:
+            for cid in item["chunks"]:
+                if seen_chunks is not None and cid in seen_chunks:
+                    continue
+                blob = _chunk_path(cid).read_bytes()
+                limit.take(len(blob))
+                decrypt_blob(key, blob)
+                if seen_chunks is not None:
+                    seen_chunks.add(cid)
+        elif "seg" in item:
+            with _segment_file(item) as f:
+                f.seek(item["off"])
+                decrypt_stream(key, _ThrottledReader(f, limit), sink, item.get("codec"))
+        elif item.get("fmt") == STREAM_FORMAT:
+            with open(VAULT_DIR / item["vault"], "rb") as f:
+                decrypt_stream(key, _ThrottledReader(f, limit), sink, item.get("codec"))
+        else:
+            blob = (VAULT_DIR / item["vault"]).read_bytes()
+            limit.take(len(blob))
+            decrypt_blob(key, blob)
+    except FileNotFoundError:
+        return "missing"
+    except Exception:
+        return "corrupt"
+    return "ok"
+
+def _item_bytes(item: dict) -> int:
+    try:
+        if item.get("fmt") == DEDUP_FORMAT:
+            return sum(_chunk_path(cid).stat().st_size for cid in item["chunks"])
+        if "seg" in item:
+            return item["len"]
+        return (VAULT_DIR / item["vault"]).stat().st_size
+    except OSError:
+        return 0
+
+@metrics.operation("scrub")
+def scrub_token(token_str: str, password: str, budget_mb: float = None, rate_mbps: float = None,
+                control: JobControl = None) -> dict:
+    """
+    Verify up to budget_mb (default SCRUB_BUDGET_MB, 0 = everything) of a token's
+    items, least recently checked first, reading at most rate_mbps (default
+    SCRUB_MBPS). Repeated runs work through the whole vault. Returns the token's
+    health summary, which is also written to HEALTH_FILE.
+    """
+    ensure_dirs()
+    key = _unlock(token_str, password)
+    if key is None:
+        print("Unknown token or wrong password"); return None
+    token_str = vault_of(token_str)
+    budget = (SCRUB_BUDGET_MB if budget_mb is None else budget_mb) * 1024 * 1024
+    rate = (SCRUB_MBPS if rate_mbps is None else rate_mbps) * 1024 * 1024
+    conn = _db()
+    rows = conn.execute(
+        "SELECT items.* FROM items LEFT JOIN health ON health.item = items.id "
+        "WHERE items.token = ? ORDER BY coalesce(health.checked, 0), items.id",
+        (token_str,),
+    )
+
+    def planned():
+        # stop handing out items once the byte budget is used up
+        used = 0
+        for r in rows:
+            item = _row_to_item(r)
+            if budget and used >= budget:
+                return
+            used += _item_bytes(item)
+            yield item
+
+    limit = _RateLimit(rate)
+    seen_chunks = set()
+    results = []
+    from concurrent.futures import ThreadPoolExecutor
+    with ThreadPoolExecutor(max_workers=WORKERS) as pool:
+        for n, (item, fut) in enumerate(_pipeline(pool, planned(), lambda it: verify_item(key, it, limit, seen_chunks),
+                                                  WORKERS * 2, control), 1):
+            status = fut.result()
+            results.append((item["id"], token_str, time.time(), status))
+            metrics.add("items.scrub_" + status)
+            if status != "ok":
+                print(f"Scrub: {status}:", item["orig"])
+            if control is not None:
+                control.report(n)
+    with meta_batch():
+        conn.executemany("INSERT OR REPLACE INTO health(item, token, checked, status) VALUES (?, ?, ?, ?)", results)
+        # forget results of items that no longer exist
+        conn.execute("DELETE FROM health WHERE token = ? AND item NOT IN (SELECT id FROM items WHERE token = ?)",
+                     (token_str, token_str))
+    summary = token_health(token_str)
+    summary["last_run"] = {"checked": len(results), "finished": time.strftime("%Y-%m-%dT%H:%M:%S")}
+    _update_health("tokens", {token_str: summary})
+    return summary
+
+def token_health(token_str: str) -> dict:
+    conn = _db()
+    total = conn.execute("SELECT count(*) FROM items WHERE token = ?", (token_str,)).fetchone()[0]
+    counts = dict(conn.execute("SELECT status, count(*) FROM health WHERE token = ? GROUP BY status", (token_str,)).fetchall())
+    bad = conn.execute(
+        "SELECT health.status, items.orig FROM health JOIN items ON items.id = health.item "
+        "WHERE health.token = ? AND health.status != 'ok' ORDER BY items.orig", (token_str,)).fetchall()
+    oldest = conn.execute("SELECT min(checked) FROM health WHERE token = ?", (token_str,)).fetchone()[0]
+    return {
+        "items": total,
+        "ok": counts.get("ok", 0),
+        "missing": [r["orig"] for r in bad if r["status"] == "missing"],
+        "corrupt": [r["orig"] for r in bad if r["status"] == "corrupt"],
+        "unchecked": total - sum(counts.values()),
+        "oldest_check": time.strftime("%Y-%m-%dT%H:%M:%S", time.localtime(oldest)) if oldest else None,
+    }
+
+# --- poller (mount events, polling fallback) ---
+class TokenSupervisor:
+    """
+    Runs reveal/hide jobs for poll_loop. Jobs for different vaults run
+    concurrently; jobs for one vault (a token and its backups) run one at a time
+    in arrival order. When a token is pulled, its queued reveal is dropped and a
+    running one cancelled, so the hide that follows starts as soon as possible.
+    """
+    def __init__(self, password: str):
+        self.password = password
+        self._lock = threading.Lock()
+        self._queues = {}    # vault -> deque of (kind, token)
+        self._running = {}   # vault -> (kind, token, JobControl, thread)
+
+    def submit(self, kind: str, token_str: str):
+        vault = vault_of(token_str)
+        with self._lock:
+            q = self._queues.setdefault(vault, deque())
+            if kind == "hide":
+                if ("reveal", token_str) in q:
+                    q.remove(("reveal", token_str))
+                run = self._running.get(vault)
+                if run and run[:2] == ("reveal", token_str):
+                    run[2].cancel()
+            q.append((kind, token_str))
+            if vault not in self._running:
+                self._start(vault)
+
+    def _start(self, vault: str):
+        # called with self._lock held
+        kind, token_str = self._queues[vault].popleft()
+        control = JobControl()
+        t = threading.Thread(target=self._run, args=(vault, kind, token_str, control),
+                             name=f"{kind}-{token_str[:8]}", daemon=True)
+        self._running[vault] = (kind, token_str, control, t)
+        t.start()
+
+    def _run(self, vault: str, kind: str, token_str: str, control: JobControl):
+        try:
+            if kind == "reveal":
+                reveal_for_token(token_str, self.password, control=control)
+            else:
+                # re-hide any restored files, then forget the key
+                hide_for_token(token_str, self.password)
+                clear_key_cache(token_str)
+        except Exception as e:
+            print(f"[{kind} failed] token={token_str}: {e}")
+        finally:
+            with self._lock:
+                del self._running[vault]
+                if self._queues[vault]:
+                    self._start(vault)
+                else:
+                    del self._queues[vault]
+
+    def shutdown(self):
+        """Drop queued reveals, cancel running ones, and wait for all hides to finish."""
+        while True:
+            with self._lock:
+                for vault, q in self._queues.items():
+                    self._queues[vault] = deque(j for j in q if j[0] == "hide")
+                for run in self._running.values():
+                    if run[0] == "reveal":
+                        run[2].cancel()
+                threads = [run[3] for run in self._running.values()]
+            if not threads:
+                return
+            for t in threads:
+                t.join()
+
 def poll_loop():
+    """
+    Event loop over mount changes and prompt answers. The mount watch and stdin
+    each run on their own thread feeding one queue, and jobs run on the
+    TokenSupervisor, so a slow hide or an unanswered prompt never delays noticing
+    the next insert or removal. Prompts are answered oldest first.
+    """
     ensure_dirs()
     print("SafeKey poller started. Press Ctrl-C to quit.")
-    known = set()
+    import getpass
     password = getpass.getpass("Enter SafeKey master password (same as used when assigning): ")
-    while True:
-        tokens = detect_mounted_tokens()  # returns {token: mountpoint}
-        # new inserted tokens
-        for tok, mount in tokens.items():
-            if tok not in known:
+    events = queue.Queue()
+
+    def watch():
+        try:
+            for ev in watch_tokens():
+                events.put(ev)
+        except Exception as e:
+            events.put(("error", str(e), None))
+
+    def answers():
+        for line in sys.stdin:
+            events.put(("answer", line.strip().lower(), None))
+
+    threading.Thread(target=watch, name="mount-watch", daemon=True).start()
+    threading.Thread(target=answers, name="prompt", daemon=True).start()
+    supervisor = TokenSupervisor(password)
+    prompts = deque()  # tokens waiting for a y/n
+
+    def ask():
+        if prompts:
+            print(f"Reveal hidden files for token {prompts[0]}? (y/n): ", end="", flush=True)
+
+    try:
+        while True:
+            event, tok, mount = events.get()
+            if event == "insert":
                 print(f"\n[USB inserted] token={tok} mount={mount}")
-                # prompt user (simple)
-                ans = input("Reveal hidden files for this USB? (y/n): ").strip().lower()
-                if ans == "y":
-                    reveal_for_token(tok, password)
-                known.add(tok)
-        # removed tokens -> hide
-        removed = [k for k in list(known) if k not in tokens]
-        for k in removed:
-            print(f"\n[USB removed] token={k}")
-            # attempt to re-hide any restored files
-            hide_for_token(k, password)
-            known.remove(k)
-        time.sleep(2)
+                prompts.append(tok)
+                if len(prompts) == 1:
+                    ask()
+            elif event == "remove":
+                print(f"\n[USB removed] token={tok}")
+                if tok in prompts:
+                    head = prompts[0] == tok
+                    prompts.remove(tok)
+                    if head:
+                        ask()
+                supervisor.submit("hide", tok)
+            elif event == "answer" and prompts:
+                if tok == "y":  # tok is the typed answer here
+                    supervisor.submit("reveal", prompts[0])
+                prompts.popleft()
+                ask()
+            elif event == "error":
+                print("Mount watch failed:", tok)
+                break
+    except KeyboardInterrupt:
+        print("\nStopping: waiting for running hide jobs ...")
+    supervisor.shutdown()
 
 # --- CLI entry ---
-if __name__ == "__main__":
-    if len(sys.argv) < 2:
-        print("Usage: provision <mount> | assign <path> | reveal <token?> | hide <token?> | poll | listdrives")
+# main() runs either here or inside cloak_daemon for a thin client; the daemon
+# sets _cli_io.prompt and _cli_io.cwd per request so password prompts reach the
+# client's terminal and relative paths resolve against the client's cwd.
+_cli_io = threading.local()
+
+def _ask_password(text: str) -> str:
+    ask = getattr(_cli_io, "prompt", None)
+    if ask:
+        return ask(text)
+    import getpass
+    return getpass.getpass(text)
+
+def _cli_path(p: str) -> str:
+    return os.path.join(getattr(_cli_io, "cwd", None) or os.getcwd(), p)
+
+def run_in_daemon(argv: list):
+    """
+    Run a CLI command in the running cloak_daemon, relaying its output and
+    password prompts. Returns the exit code, or None if no daemon answered.
+    Wire format: one JSON object per line; the client sends {"argv", "cwd"} and
+    answers each {"prompt"} with {"answer"}; the daemon streams {"out"} until {"exit"}.
+    """
+    if not USE_DAEMON or not DAEMON_SOCKET.exists():
+        return None
+    import socket
+    import getpass
+    s = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        s.connect(str(DAEMON_SOCKET))
+    except OSError:
+        s.close()
+        return None
+    with s, s.makefile("rwb") as f:
+        f.write(json.dumps({"argv": argv, "cwd": os.getcwd()}).encode() + b"\n")
+        f.flush()
+        for line in f:
+            msg = json.loads(line)
+            if "out" in msg:
+                sys.stdout.write(msg["out"])
+                sys.stdout.flush()
+            elif "prompt" in msg:
+                f.write(json.dumps({"answer": getpass.getpass(msg["prompt"])}).encode() + b"\n")
+                f.flush()
+            elif "exit" in msg:
+                return msg["exit"]
+    print("Lost connection to cloak daemon")
+    return 1
+
+def main(argv: list) -> int:
+    if len(argv) < 2:
+        print("Usage: provision <mount> | assign [--dedup] <path> | reveal <token?> [subpath] | hide <token?> [subpath] | poll | listdrives | compact | gc | scrub <token?> [budget_mb]"
+              " | passwd <token> | addbackup <token> <mount> | replace <token> <mount> | calibrate")
         sys.exit(1)
-    cmd = sys.argv[1]
+    cmd = argv[1]
     ensure_dirs()
     if cmd == "provision":
-        if len(sys.argv) < 3:
+        if len(argv) < 3:
             print("usage: provision /path/to/mount"); sys.exit(1)
-        provision(sys.argv[2])
+        provision(_cli_path(argv[2]))
     elif cmd == "assign":
-        if len(sys.argv) < 3:
-            print("usage: assign /path/to/file_or_folder"); sys.exit(1)
-        pwd = getpass.getpass("Enter master password: ")
-        assign_path(sys.argv[2], pwd)
+        args = [a for a in argv[2:] if a != "--dedup"]
+        if not args:
+            print("usage: assign [--dedup] /path/to/file_or_folder"); sys.exit(1)
+        pwd = _ask_password("Enter master password: ")
+        assign_path(_cli_path(args[0]), pwd, dedup=True if "--dedup" in argv else None)
     elif cmd == "reveal":
         tokens = detect_mounted_tokens()
-        if tokens and len(tokens) == 1 and len(sys.argv) == 2:
+        if tokens and len(tokens) == 1 and len(argv) == 2:
             tok, _ = next(iter(tokens.items()))
-            pwd = getpass.getpass("Enter master password: ")
+            pwd = _ask_password("Enter master password: ")
             reveal_for_token(tok, pwd)
-        elif len(sys.argv) >= 3:
-            pwd = getpass.getpass("Enter master password: ")
-            reveal_for_token(sys.argv[2], pwd)
+        elif len(argv) >= 3:
+            pwd = _ask_password("Enter master password: ")
+            reveal_for_token(argv[2], pwd, subpath=_cli_path(argv[3]) if len(argv) > 3 else None)
         else:
             print("No token specified and no single USB detected.")
     elif cmd == "hide":
         tokens = detect_mounted_tokens()
-        if tokens and len(tokens) == 1 and len(sys.argv) == 2:
+        if tokens and len(tokens) == 1 and len(argv) == 2:
             tok, _ = next(iter(tokens.items()))
-            pwd = getpass.getpass("Enter master password: ")
+            pwd = _ask_password("Enter master password: ")
             hide_for_token(tok, pwd)
-        elif len(sys.argv) >= 3:
-            pwd = getpass.getpass("Enter master password: ")
-            hide_for_token(sys.argv[2], pwd)
+        elif len(argv) >= 3:
+            pwd = _ask_password("Enter master password: ")
+            hide_for_token(argv[2], pwd, subpath=_cli_path(argv[3]) if len(argv) > 3 else None)
         else:
             print("No token specified and no single USB detected.")
     elif cmd == "poll":
         poll_loop()
+    elif cmd == "compact":
+        print("Reclaimed", compact_segments(), "bytes from vault segments")
+    elif cmd == "passwd":
+        if len(argv) < 3:
+            print("usage: passwd <token>"); sys.exit(1)
+        old = _ask_password("Current master password: ")
+        new = _ask_password("New master password: ")
+        if new != _ask_password("Repeat new password: "):
+            print("Passwords differ"); sys.exit(1)
+        n = change_password(argv[2], old, new)
+        print(f"Password changed for {n} token(s)" if n else "Unknown token or wrong password")
+    elif cmd in ("addbackup", "replace"):
+        if len(argv) < 4:
+            print(f"usage: {cmd} <token> /path/to/new/usb/mount"); sys.exit(1)
+        pwd = _ask_password("Enter master password: ")
+        if add_backup_token(argv[2], pwd, _cli_path(argv[3]), replace=cmd == "replace") is None:
+            print("Unknown token or wrong password")
+    elif cmd == "calibrate":
+        params = kdf_policy(recalibrate=True)
+        print(f"KDF for new and upgraded keys (~{KDF_TARGET_MS:.0f} ms per unlock):", json.dumps(params))
+    elif cmd == "gc":
+        stats = gc_vault()
+        print(f"Removed {stats['orphan_blobs']} orphan blobs and {stats['orphan_chunks']} orphan chunks,"
+              f" freed {stats['bytes_freed']} bytes; {stats['items_missing_storage']} items have missing storage")
+    elif cmd == "scrub":
+        tokens = detect_mounted_tokens()
+        if len(argv) >= 3:
+            tok = argv[2]
+        elif len(tokens) == 1:
+            tok = next(iter(tokens))
+        else:
+            print("No token specified and no single USB detected."); sys.exit(1)
+        pwd = _ask_password("Enter master password: ")
+        summary = scrub_token(tok, pwd, budget_mb=float(argv[3]) if len(argv) > 3 else None)
+        if summary:
+            print(f"{summary['ok']}/{summary['items']} items verified ok, {len(summary['corrupt'])} corrupt,"
+                  f" {len(summary['missing'])} missing, {summary['unchecked']} not checked yet; see {HEALTH_FILE}")
     elif cmd == "listdrives":
-        # debug helper to print drives
+        # debug helper to print drives (--refresh re-reads every token file)
         print("All removable drives found:")
-        for mount, label, token in list_all_usb_drives():
+        for mount, label, token in list_all_usb_drives(refresh="--refresh" in argv):
             print(f"{mount}  (label={label})  token={'YES' if token else 'NO'}")
     else:
         print("Unknown command")
+        return 1
+    return 0
+
+if __name__ == "__main__":
+    code = None
+    if len(sys.argv) > 1 and sys.argv[1] != "poll":  # the poller is interactive, keep it local
+        code = run_in_daemon(sys.argv)
+    sys.exit(main(sys.argv) if code is None else code)
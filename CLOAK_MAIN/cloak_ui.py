@@ -1,14 +1,145 @@
 # cloak_ui.py (fixed: QLineEdit echo + QSize)
 from PySide6.QtWidgets import (
-    QApplication, QWidget, QVBoxLayout, QHBoxLayout, QPushButton,
+    QApplication, QWidget, QVBoxLayout, QHBoxLayout, QPushButton, QListView, QAbstractItemView,
     QListWidget, QListWidgetItem, QFileDialog, QLabel, QMessageBox, QInputDialog, QLineEdit
 )
-from PySide6.QtCore import Qt, QTimer, QSize
+from PySide6.QtGui import QStandardItemModel, QStandardItem
+from PySide6.QtCore import Qt, QTimer, QSize, QSocketNotifier, QObject, QRunnable, QThreadPool, Signal
 import sys
+import time
+from collections import deque
 from pathlib import Path
-import os
+import itertools
 import cloak_manager as sk
 
+# --- drive scanning ---
+class DriveScanSignals(QObject):
+    done = Signal(object)   # list of (mount, label, token)
+    failed = Signal(str)
+
+class DriveScan(QRunnable):
+    """
+    Runs sk.list_all_usb_drives() off the Qt thread (slow mounts can stall it).
+    refresh=True bypasses the drive cache and re-reads every token file.
+    """
+    def __init__(self, refresh=False):
+        super().__init__()
+        self.refresh = refresh
+        self.signals = DriveScanSignals()
+
+    def run(self):
+        try:
+            drives = sk.list_all_usb_drives(refresh=self.refresh)
+        except Exception as e:
+            self.signals.failed.emit(str(e))
+        else:
+            self.signals.done.emit(drives)
+
+# --- background jobs ---
+class JobSignals(QObject):
+    progress = Signal(int, int)   # done, total (-1 when unknown)
+    finished = Signal(object)     # return value of the job function
+    failed = Signal(str)
+
+class Job(QRunnable):
+    """
+    One assign/reveal operation run on the thread pool.
+    fn(control) does the work and checks control (a sk.JobControl) between files;
+    progress is forwarded to the Qt thread at most every PROGRESS_INTERVAL seconds.
+    """
+    PROGRESS_INTERVAL = 0.1
+
+    def __init__(self, usb: str, title: str, fn):
+        super().__init__()
+        self.setAutoDelete(False)
+        self.usb = usb
+        self.title = title
+        self.fn = fn
+        self.state = "queued"
+        self.done = 0
+        self.total = -1
+        self.signals = JobSignals()
+        self.control = sk.JobControl(progress=self._progress)
+        self._last_emit = 0.0
+        self._latest = None
+
+    def _progress(self, done, total):
+        self._latest = (done, -1 if total is None else total)
+        now = time.monotonic()
+        if now - self._last_emit >= self.PROGRESS_INTERVAL:
+            self._last_emit = now
+            self.signals.progress.emit(*self._latest)
+
+    def run(self):
+        try:
+            result = self.fn(self.control)
+        except Exception as e:
+            self.signals.failed.emit(str(e))
+        else:
+            if self._latest is not None:
+                self.signals.progress.emit(*self._latest)
+            self.signals.finished.emit(result)
+
+class JobQueue(QObject):
+    """Runs jobs on a QThreadPool: one at a time per USB, different USBs in parallel."""
+    changed = Signal(object)  # the Job whose state or progress changed
+
+    def __init__(self, parent=None):
+        super().__init__(parent)
+        self.pool = QThreadPool.globalInstance()
+        self.pending = {}   # usb -> deque of queued jobs
+        self.running = {}   # usb -> running job
+
+    def submit(self, job: Job):
+        job.signals.progress.connect(lambda done, total: self._on_progress(job, done, total))
+        job.signals.finished.connect(lambda result: self._on_done(job, "cancelled" if job.control.cancelled else "done"))
+        job.signals.failed.connect(lambda err: self._on_done(job, "failed", err))
+        self.pending.setdefault(job.usb, deque()).append(job)
+        self.changed.emit(job)
+        self._start_next(job.usb)
+
+    def cancel(self, job: Job):
+        queue = self.pending.get(job.usb)
+        if queue and job in queue:
+            queue.remove(job)
+            job.state = "cancelled"
+            self.changed.emit(job)
+        else:
+            job.control.cancel()
+
+    def pause(self, job: Job):
+        job.control.pause()
+        if job.state == "running":
+            job.state = "paused"
+            self.changed.emit(job)
+
+    def resume(self, job: Job):
+        job.control.resume()
+        if job.state == "paused":
+            job.state = "running"
+            self.changed.emit(job)
+
+    def _start_next(self, usb: str):
+        queue = self.pending.get(usb)
+        if usb in self.running or not queue:
+            return
+        job = queue.popleft()
+        job.state = "paused" if job.control.paused else "running"
+        self.running[usb] = job
+        self.changed.emit(job)
+        self.pool.start(job)
+
+    def _on_progress(self, job: Job, done: int, total: int):
+        job.done, job.total = done, total
+        self.changed.emit(job)
+
+    def _on_done(self, job: Job, state: str, error: str = None):
+        job.state = state
+        job.error = error
+        self.running.pop(job.usb, None)
+        self.changed.emit(job)
+        self._start_next(job.usb)
+
 class SafeKeyUI(QWidget):
     def __init__(self):
         super().__init__()
@@ -19,12 +150,16 @@ class SafeKeyUI(QWidget):
         # Left: USB drives
         left = QVBoxLayout()
         left.addWidget(QLabel("<b>Connected USB Drives</b>"))
-        self.usb_list = QListWidget()
-        self.usb_list.setSelectionMode(QListWidget.SingleSelection)
-        self.usb_list.itemSelectionChanged.connect(self.on_usb_selection_changed)
+        # model/view list updated in place from scan diffs, so selection survives refreshes
+        self.usb_model = QStandardItemModel(self)
+        self.usb_list = QListView()
+        self.usb_list.setModel(self.usb_model)
+        self.usb_list.setSelectionMode(QAbstractItemView.SingleSelection)
+        self.usb_list.setEditTriggers(QAbstractItemView.NoEditTriggers)
+        self.usb_list.selectionModel().currentChanged.connect(self.on_usb_selection_changed)
         left.addWidget(self.usb_list)
         btn_refresh = QPushButton("Refresh USBs")
-        btn_refresh.clicked.connect(self.refresh_tokens)
+        btn_refresh.clicked.connect(lambda: self.refresh_tokens(refresh=True))
         left.addWidget(btn_refresh)
         btn_provision = QPushButton("Provision Selected USB")
         btn_provision.clicked.connect(self.provision_usb_dialog)
@@ -61,50 +196,134 @@ class SafeKeyUI(QWidget):
         btn_reveal = QPushButton("Reveal files for chosen USB")
         btn_reveal.clicked.connect(self.reveal_for_chosen_usb)
         right.addWidget(btn_reveal)
-        right.addStretch(1)
+        right.addSpacing(10)
+        right.addWidget(QLabel("<b>Jobs</b>"))
+        self.jobs_list = QListWidget()
+        right.addWidget(self.jobs_list)
+        jh = QHBoxLayout()
+        for text, slot in (("Pause", self.pause_selected_job), ("Resume", self.resume_selected_job),
+                           ("Cancel", self.cancel_selected_job)):
+            btn = QPushButton(text)
+            btn.clicked.connect(slot)
+            jh.addWidget(btn)
+        right.addLayout(jh)
         layout.addLayout(right, 1)
 
+        self.jobs = JobQueue(self)
+        self.jobs.changed.connect(self.on_job_changed)
+        self.job_items = {}
+
         self.setLayout(layout)
+        self.known_tokens = set()
+        self.scan_running = False
+        self.scan_again = False
+        self.scan_again_refresh = False
         self.refresh_tokens()
 
-        # refresh tokens periodically (in case user plugs/unplugs)
-        self.timer = QTimer(self)
-        self.timer.timeout.connect(self.refresh_tokens)
-        self.timer.start(2500)
+        # refresh tokens when the mount table changes; poll where that can't be watched
+        self.mount_watch = sk.open_mount_watch()
+        if self.mount_watch is not None:
+            self.mount_notifier = QSocketNotifier(self.mount_watch.fileno(), QSocketNotifier.Exception, self)
+            self.mount_notifier.activated.connect(self.on_mount_change)
+        else:
+            self.timer = QTimer(self)
+            self.timer.timeout.connect(self.refresh_tokens)
+            self.timer.start(2500)
+
+    def on_mount_change(self):
+        sk.rearm_mount_watch(self.mount_watch)
+        self.refresh_tokens()
 
     # --- drive listing / selection helpers ---
-    def refresh_tokens(self):
+    def refresh_tokens(self, refresh=False):
         """
-        Populate usb_list with all removable drives.
-        Each QListWidgetItem holds (token_or_None, mount) in Qt.UserRole.
+        Rescan drives on the thread pool; apply_drive_scan() merges the result.
+        A refresh requested while a scan runs is coalesced into one more scan.
+        refresh=True (the Refresh USBs button) skips the drive cache.
         """
-        self.usb_list.clear()
-        try:
-            drives = sk.list_all_usb_drives()
-        except Exception as e:
-            QMessageBox.critical(self, "Error", f"Failed to list drives:\n{e}")
+        if self.scan_running:
+            self.scan_again = True
+            self.scan_again_refresh |= refresh
             return
+        self.scan_running = True
+        scan = DriveScan(refresh)
+        scan.signals.done.connect(self.apply_drive_scan)
+        scan.signals.failed.connect(self.on_drive_scan_failed)
+        QThreadPool.globalInstance().start(scan)
+
+    def on_drive_scan_failed(self, err):
+        self.finish_drive_scan()
+        QMessageBox.critical(self, "Error", f"Failed to list drives:\n{err}")
+
+    def finish_drive_scan(self):
+        self.scan_running = False
+        if self.scan_again:
+            refresh = self.scan_again_refresh
+            self.scan_again = self.scan_again_refresh = False
+            self.refresh_tokens(refresh)
 
+    def apply_drive_scan(self, drives):
+        """
+        Update usb_model in place: drop rows for mounts that went away, update rows
+        whose token/label changed, append new mounts. Untouched rows (and the
+        current selection) are left alone.
+        Each row holds (token_or_None, mount) in Qt.UserRole.
+        """
+        self.finish_drive_scan()
+
+        # drop cached keys of tokens whose USB was pulled since the last refresh
+        present = {token for _, _, token in drives if token}
+        for token in self.known_tokens - present:
+            sk.clear_key_cache(token)
+        self.known_tokens = present
+
+        wanted = {mount: (label, token) for mount, label, token in drives}
+        current = self.current_drive()
+        if current and current[1] not in wanted:
+            # don't let the selection slide onto a neighbouring drive
+            self.usb_list.selectionModel().clear()
+        seen = set()
+        for row in reversed(range(self.usb_model.rowCount())):
+            item = self.usb_model.item(row)
+            token, mount = item.data(Qt.UserRole)
+            if mount not in wanted:
+                self.usb_model.removeRow(row)
+                continue
+            seen.add(mount)
+            label, new_token = wanted[mount]
+            if new_token != token or item.data(Qt.UserRole + 1) != label:
+                self.set_drive_item(item, mount, label, new_token)
         for mount, label, token in drives:
-            if token:
-                title = f"[PROVISIONED] {token}"
-            else:
-                title = f"[UNPROVISIONED] {label}"
-            display = f"{title}\n{mount}"
-            item = QListWidgetItem(display)
-            item.setData(Qt.UserRole, (token, mount))
-            # make item slightly taller so long paths wrap better
-            item.setSizeHint(item.sizeHint() + QSize(0, 10))
-            self.usb_list.addItem(item)
+            if mount not in seen:
+                item = QStandardItem()
+                self.set_drive_item(item, mount, label, token)
+                self.usb_model.appendRow(item)
+        self.on_usb_selection_changed()
 
-        self.selected_label.setText("Selected: None")
+    def set_drive_item(self, item, mount, label, token):
+        if token:
+            title = f"[PROVISIONED] {token}"
+        else:
+            title = f"[UNPROVISIONED] {label}"
+        item.setText(f"{title}\n{mount}")
+        item.setData((token, mount), Qt.UserRole)
+        item.setData(label, Qt.UserRole + 1)
+        # make item slightly taller so long paths wrap better
+        item.setSizeHint(QSize(0, self.usb_list.fontMetrics().height() * 2 + 14))
+
+    def current_drive(self):
+        """(token_or_None, mount) of the selected drive, or None."""
+        idx = self.usb_list.currentIndex()
+        if not idx.isValid():
+            return None
+        return idx.data(Qt.UserRole)
 
     def provision_usb_dialog(self):
-        it = self.usb_list.currentItem()
-        if not it:
+        drive = self.current_drive()
+        if not drive:
             QMessageBox.warning(self, "No USB selected", "Select a USB drive from the left list to provision.")
             return
-        token, mount = it.data(Qt.UserRole)
+        token, mount = drive
         if mount is None:
             QMessageBox.critical(self, "Error", "Selected item has no mount info.")
             return
@@ -129,12 +348,12 @@ class SafeKeyUI(QWidget):
         for it in list(self.items_list.selectedItems()):
             self.items_list.takeItem(self.items_list.row(it))
 
-    def on_usb_selection_changed(self):
-        it = self.usb_list.currentItem()
-        if not it:
+    def on_usb_selection_changed(self, *_):
+        drive = self.current_drive()
+        if not drive:
             self.selected_label.setText("Selected: None")
             return
-        token, mount = it.data(Qt.UserRole)
+        token, mount = drive
         if token:
             self.selected_label.setText(f"Selected: {mount}  (provisioned)")
         else:
@@ -149,11 +368,11 @@ class SafeKeyUI(QWidget):
 
     # --- assign / reveal ---
     def assign_selected_to_usb(self):
-        it = self.usb_list.currentItem()
-        if not it:
+        drive = self.current_drive()
+        if not drive:
             QMessageBox.warning(self, "No USB selected", "Select a USB drive from the left list first.")
             return
-        token, mount = it.data(Qt.UserRole)
+        token, mount = drive
         if mount is None:
             QMessageBox.warning(self, "No USB mount", "Selected list item has no mountpoint.")
             return
@@ -171,13 +390,8 @@ class SafeKeyUI(QWidget):
             if res == QMessageBox.Yes:
                 try:
                     token = sk.provision(mount)
+                    # the row for this mount is updated in place, so it stays selected
                     self.refresh_tokens()
-                    for i in range(self.usb_list.count()):
-                        it2 = self.usb_list.item(i)
-                        t2, m2 = it2.data(Qt.UserRole)
-                        if m2 == mount:
-                            self.usb_list.setCurrentItem(it2)
-                            break
                 except Exception as e:
                     QMessageBox.critical(self, "Provision failed", str(e))
                     return
@@ -188,78 +402,104 @@ class SafeKeyUI(QWidget):
         if pwd is None:
             return
 
-        meta = sk.read_meta()
-        if token not in meta:
-            QMessageBox.critical(self, "Unknown token", "Token not found in local meta. Provision may have failed.")
-            return
-        try:
-            salt = sk.base64.b64decode(meta[token]["salt"])
-            key = sk.derive_key(pwd, token.encode(), salt)
-        except Exception as e:
-            QMessageBox.critical(self, "Error", f"Failed to derive key: {e}")
-            return
-
-        failed = []
-        succeeded = 0
         paths = [self.items_list.item(i).text() for i in range(self.items_list.count())]
-        for path in paths:
-            p = Path(path)
-            if p.is_file():
-                try:
-                    data = p.read_bytes()
-                    ct = sk.encrypt_blob(key, data)
-                    sk._save_vault_item(token, str(p), ct)
-                    sk.secure_delete_file(p)
-                    succeeded += 1
-                except Exception as e:
-                    failed.append(f"{path}: {e}")
-            elif p.is_dir():
-                for root, dirs, files in os.walk(p):
-                    for fname in files:
-                        fpath = Path(root) / fname
-                        try:
-                            data = fpath.read_bytes()
-                            ct = sk.encrypt_blob(key, data)
-                            sk._save_vault_item(token, str(fpath), ct)
-                            sk.secure_delete_file(fpath)
-                            succeeded += 1
-                        except Exception as e:
-                            failed.append(f"{fpath}: {e}")
-            else:
-                failed.append(f"{path}: not found")
 
-        try:
-            sk.write_meta(sk.read_meta())
-        except Exception:
-            pass
-
-        msg = f"Assigned {succeeded} items to USB."
-        if failed:
-            msg += "\n\nSome errors:\n" + "\n".join(failed[:8])
-        QMessageBox.information(self, "Done", msg)
+        def work(control):
+            # runs on the thread pool: KDF, encryption and disk I/O stay off the Qt thread
+            key = sk._unlock(token, pwd)
+            if key is None:
+                raise RuntimeError("Wrong password, or token not found in local meta (provision may have failed).")
+            failed = []
+            files = []
+            for path in paths:
+                p = Path(path)
+                if p.exists():
+                    files.append(sk.iter_files(p))
+                else:
+                    failed.append(f"{path}: not found")
+            succeeded, errors = sk.assign_files(token, key, itertools.chain.from_iterable(files), control=control)
+            failed.extend(f"{fpath}: {e}" for fpath, e in errors)
+            msg = f"Assigned {succeeded} items to USB."
+            if failed:
+                msg += "\n\nSome errors:\n" + "\n".join(failed[:8])
+            return msg
+
+        self.submit_job(mount, f"Assign {len(paths)} item(s) → {mount}", work)
         self.items_list.clear()
-        self.refresh_tokens()
 
     def reveal_for_chosen_usb(self):
-        it = self.usb_list.currentItem()
-        if not it:
+        drive = self.current_drive()
+        if not drive:
             QMessageBox.warning(self, "No USB selected", "Select a USB drive from the left list first.")
             return
-        token, mount = it.data(Qt.UserRole)
+        token, mount = drive
         if token is None:
             QMessageBox.information(self, "Not provisioned", "This USB is not provisioned. Provision it first to reveal files.")
             return
         pwd = self.ask_password("Enter master password for reveal")
         if pwd is None:
             return
-        try:
-            restored = sk.reveal_for_token(token, pwd)
+
+        def work(control):
+            restored = sk.reveal_for_token(token, pwd, control=control)
             if restored:
-                QMessageBox.information(self, "Reveal finished", f"Revealed {len(restored)} items (restored to original paths).")
-            else:
-                QMessageBox.information(self, "Reveal", "No items restored (maybe already present or decryption failed).")
-        except Exception as e:
-            QMessageBox.critical(self, "Error", f"Reveal failed:\n{e}")
+                return f"Revealed {len(restored)} items (restored to original paths)."
+            return "No items restored (maybe already present or decryption failed)."
+
+        self.submit_job(mount, f"Reveal {token} ({mount})", work)
+
+    # --- job list ---
+    def submit_job(self, usb, title, fn):
+        job = Job(usb, title, fn)
+        item = QListWidgetItem()
+        item.setData(Qt.UserRole, job)
+        self.jobs_list.addItem(item)
+        self.job_items[job] = item
+        job.signals.finished.connect(lambda msg: self.notify(job.title, msg))
+        job.signals.failed.connect(lambda err: self.notify(job.title, f"Failed:\n{err}", QMessageBox.Critical))
+        self.jobs.submit(job)
+
+    def on_job_changed(self, job):
+        item = self.job_items.get(job)
+        if item is None:
+            return
+        if job.total > 0:
+            progress = f"{job.done}/{job.total}"
+        else:
+            progress = f"{job.done} files"
+        item.setText(f"[{job.state}] {job.title}\n{progress}")
+
+    def selected_job(self):
+        it = self.jobs_list.currentItem()
+        return it.data(Qt.UserRole) if it else None
+
+    def pause_selected_job(self):
+        job = self.selected_job()
+        if job:
+            self.jobs.pause(job)
+
+    def resume_selected_job(self):
+        job = self.selected_job()
+        if job:
+            self.jobs.resume(job)
+
+    def cancel_selected_job(self):
+        job = self.selected_job()
+        if job:
+            self.jobs.cancel(job)
+
+    def notify(self, title, msg, icon=QMessageBox.Information):
+        # non-modal, so finishing jobs never block the event loop or each other
+        box = QMessageBox(icon, title, msg, QMessageBox.Ok, self)
+        box.setAttribute(Qt.WA_DeleteOnClose)
+        box.setModal(False)
+        box.show()
+
+    def closeEvent(self, event):
+        for job in list(self.jobs.running.values()):
+            job.control.cancel()
+        self.jobs.pool.waitForDone()
+        super().closeEvent(event)
 
 if __name__ == "__main__":
     app = QApplication(sys.argv)